@@ -1,27 +1,37 @@
 import numpy as np
 import math
+import random
 from random import gauss, random as rand
-from logging import basicConfig, debug, DEBUG
+from logging import debug
 import copy
 
-basicConfig(level=DEBUG,
-            format='(%(threadName)-10s) %(message)s',
-            )
+from aggregate import MetricHistory
 
 class Watcher():
     """
     This class handles the clairvoyance of the system, watching all sales
     """
 
-    def __init__(self):
+    def __init__(self, history=None):
+        # Adaptive candidate selection: the width each class of actor starts
+        # from, its (min, max) bounds, and per-step [calls, out of stock, widened]
+        self.widths = {}
+        self.width_bounds = {}
+        self.selection = {}
         self.reset()
-        self.mean_quality_list = []
+        # With a history size, mean qualities are kept in constant memory
+        self.mean_quality_list = [] if history is None else MetricHistory(history)
         self.sup_no_sales = {}
+        # Optional callbacks for each retail sale (given the seller) and each
+        # wholesale (given the supplier), used by event-driven schedulers
+        self.on_sale = None
+        self.on_wholesale = None
 
     def reset(self):
         self.reset_sales()
         self.reset_stock()
         self.reset_choices()
+        self.reset_selection()
 
     def reset_sales(self):
         self.num_purchases = 0
@@ -33,6 +43,46 @@ class Watcher():
     def reset_stock(self):
         self.out_of_stock = 0
 
+    def reset_selection(self):
+        """
+        Sets each class's starting width for the next step from its stock-out
+        rate in this one: doubled if more than 1 in 10 choices met an empty
+        shelf, halved if fewer than 1 in 100 did
+        """
+        for kind, (calls, oos, widened) in self.selection.items():
+            low, high = self.width_bounds[kind]
+            rate = oos / calls if calls else 0.
+            if rate > 0.1:
+                self.widths[kind] = min(2*self.widths[kind], high)
+            elif rate < 0.01:
+                self.widths[kind] = max(self.widths[kind] // 2, low)
+        self.selection = {}
+
+    def candidate_width(self, kind, low, high):
+        """ How many candidates an actor of this class should rank first """
+        if kind not in self.widths:
+            self.widths[kind] = low
+            self.width_bounds[kind] = (low, high)
+        return self.widths[kind]
+
+    def inform_selection(self, kind, oos, width, widened):
+        """
+        Records one adaptive choice. A widened ranking is kept as the class's
+        width for the rest of the step
+        """
+        stats = self.selection.setdefault(kind, [0, 0, 0])
+        stats[0] += 1
+        stats[1] += oos
+        if widened:
+            stats[2] += 1
+            self.widths[kind] = max(self.widths[kind], width)
+
+    def selection_stats(self):
+        """ Width, stock-out rate and widenings of each class in this step """
+        return {kind: {'width': self.widths[kind], 'calls': calls,
+                        'oos_rate': oos / calls if calls else 0., 'widened': widened}
+                for kind, (calls, oos, widened) in self.selection.items()}
+
     def get_mean_qual(self):
         self.mean_quality_list.append(self.mean_quality)
         return self.mean_quality
@@ -41,6 +91,20 @@ class Watcher():
         self.mean_quality = (self.mean_quality*self.num_purchases +
                                 seller.quality) / (self.num_purchases+1)
         self.num_purchases += 1
+        if self.on_sale is not None:
+            self.on_sale(seller)
+
+    def inform_sales(self, seller, count):
+        """ Records count purchases from the same seller at once """
+        self.mean_quality = (self.mean_quality*self.num_purchases +
+                                seller.quality*count) / (self.num_purchases+count)
+        self.num_purchases += count
+        if self.on_sale is not None:
+            self.on_sale(seller)
+
+    def inform_wholesale(self, supplier):
+        if self.on_wholesale is not None:
+            self.on_wholesale(supplier)
 
     def inform_choice(self, uid):
         if uid in self.choice_tally:
@@ -57,11 +121,33 @@ class Watcher():
         else:
             self.sup_no_sales[sup_id] = 1
 
+    def forget_supplier(self, sup_id):
+        """ Drops a supplier that has gone bust, so churn does not grow the tally """
+        self.sup_no_sales.pop(sup_id, None)
+
     def get_top(self):
         v = list(self.choice_tally.values())
         k = list(self.choice_tally.keys())
         return k[v.index(max(v))], max(v)
 
+def periodic_distances(position, positions, system_size):
+    """
+    Vectorised form of Actor.distance_to: the distances from one position to
+    an (n, 2) array of positions, with periodic boundaries
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    if type(system_size) is float or type(system_size) is int: # 1D case
+        raw_dist = np.abs(positions[:, 0] - position[0])
+        return np.where(raw_dist > system_size/2, system_size - raw_dist, raw_dist)
+
+    x_dist = np.abs(positions[:, 0] - position[0])
+    y_dist = np.abs(positions[:, 1] - position[1])
+    x_dist = np.where(x_dist > system_size[0]/2, system_size[0] - x_dist, x_dist)
+    y_dist = np.where(y_dist > system_size[1]/2, system_size[1] - y_dist, y_dist)
+
+    return np.sqrt( x_dist**2 + y_dist**2 )
+
+
 class Environment():
     """ This class models the total environment of the simulaion. For now it
         only contains towns but this could be extended
@@ -104,6 +190,18 @@ class Environment():
         # Get a new position from it
         return town.get_position()
 
+    def get_positions(self, n, rng=None):
+        """
+        Draws n positions at once, returned as an (n, 2) array. Draws come from
+        rng, a numpy Generator, if given, and the global generator otherwise
+        """
+        rng = np.random if rng is None else rng
+        choice = rng.choice(len(self.towns), size=n, p=self.prob_dist)
+        centres = np.array([(t.x, t.y) for t in self.towns]).reshape(-1, 2)
+        sigmas = np.array([(t.sigmax, t.sigmay) for t in self.towns]).reshape(-1, 2)
+
+        return centres[choice] + sigmas[choice]*rng.standard_normal((n, 2))
+
 
 class Town():
     """ This class models a town in the simulation """
@@ -129,19 +227,88 @@ class Town():
 
 
 
+class OutcomeStream():
+    """
+    This class draws the uniform numbers that decide whether medicine works,
+    from its own generator rather than the shared one. Two simulations seeded
+    alike draw the same outcomes (common random numbers), and an antithetic
+    stream draws 1-u wherever its twin draws u
+    """
+
+    def __init__(self, seed=None, antithetic=False):
+        # Kept apart from the shared generator, even when that has the same seed
+        self.random     = random.Random(None if seed is None else "outcomes:{}".format(seed)).random
+        self.antithetic = antithetic
+
+    def uniform(self):
+        u = self.random()
+        return 1 - u if self.antithetic else u
+
+
+class Parameters():
+    """
+    This class holds the behavioural parameters shared by all actors of one
+    simulation, so that different simulations can use different values in the
+    same process
+    """
+
+    names = ('distance_parameter', 'explore_parameter', 'cost_parameter',
+                'top_n', 'epsilon', 'bust_number', 'experience_dtype', 'discount',
+                'adaptive_top_n', 'min_top_n')
+    # The names whose values are numbers, and so can be swept and tabulated
+    numeric = tuple(name for name in names if name not in ('experience_dtype', 'adaptive_top_n'))
+
+    def __init__(self, distance_parameter=0.001, explore_parameter=0.5,
+                    cost_parameter=0.3, top_n=20, epsilon=0.1, bust_number=20,
+                    experience_dtype='int16', discount=1.0, adaptive_top_n=False, min_top_n=1,
+                    outcomes=None):
+        self.distance_parameter = distance_parameter
+        self.explore_parameter  = explore_parameter
+        self.cost_parameter     = cost_parameter
+
+        self.top_n          = int(top_n)
+        self.epsilon        = epsilon
+        self.bust_number    = int(bust_number)
+
+        # Experience counters are halved when they reach the largest value of
+        # their type. With a discount below 1, every past trial is instead
+        # weighted by discount**(trials since), and counters are floats
+        self.experience_dtype   = np.dtype(experience_dtype).name
+        self.experience_max     = np.iinfo(self.experience_dtype).max
+        self.discount           = float(discount)
+
+        # With adaptive_top_n, choose_best ranks only as many candidates as
+        # recent stock-outs call for (at least min_top_n), widening up to top_n
+        self.adaptive_top_n = bool(adaptive_top_n)
+        self.min_top_n      = int(min_top_n)
+
+        # An OutcomeStream for treatment outcomes, or None to use the shared
+        # generator. It is not a behavioural parameter, so it is not in names
+        self.outcomes = outcomes
+
+    def __repr__(self):
+        return "Parameters({})".format(", ".join(
+            "{}={!r}".format(name, getattr(self, name)) for name in self.names))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.names}
+
+    def replace(self, **changes):
+        """ Returns a copy of these parameters with some values changed """
+        values = self.as_dict()
+        for name in changes:
+            if name not in values:
+                raise AttributeError("Unknown parameter: {}".format(name))
+        values.update(changes)
+        return Parameters(outcomes=self.outcomes, **values)
+
+
 class Actor():
     """ This is the generalised class for actors in the simulation """
-    # Constants for all actors
-    distance_parameter = 0.001
-    explore_parameter = 0.5
-    cost_parameter = 0.3
-
-    top_n = 20
-    epsilon = 0.1
-    bust_number = 20
 
-    def __init__(self, position, uid, system_size, watcher=None, dynam_price=False):
+    def __init__(self, position, uid, system_size, watcher=None, dynam_price=False, params=None):
         self.watcher        = watcher
+        self.params         = params if params is not None else Parameters()
         self.position       = position
         self.uid            = uid
         self.min_purchase   = 1
@@ -153,6 +320,7 @@ class Actor():
         self.distances      = {}
                             # successes , trials (of that seller/supplier)
         self.N              = 0 # Total number of trials
+        self.discounted_N   = 0. # The same, discounted (only used with a discount)
 
 
     def distance_to(self, position):
@@ -193,41 +361,101 @@ class Actor():
             actor_uid = actor.uid
             self.distances[actor_uid] = self.distance_to(actor.position)
             if actor_uid not in self.experiences:
-                self.experiences[actor_uid] = np.zeros(2, dtype=np.int16)
+                self.experiences[actor_uid] = self.new_experience()
                 # We also initialise the experiences counter here
 
+    def new_experience(self):
+        """
+        The counters for a vendor not yet tried: successes and trials, and when
+        discounting, the value of N they were last brought up to date at
+        """
+        if self.params.discount < 1:
+            return np.array([0., 0., self.N])
+        return np.zeros(2, dtype=self.params.experience_dtype)
+
+    def current_experience(self, uid):
+        """ Brings a vendor's discounted counters up to date """
+        record = self.experiences[uid]
+        if record[2] != self.N:
+            record[:2] *= self.params.discount**(self.N - record[2])
+            record[2] = self.N
+        return record
+
+    def record_trial(self, uid, success):
+        """ Adds a trial of a vendor, which succeeded or not """
+        if self.params.discount < 1:
+            record = self.current_experience(uid)
+        else:
+            record = self.experiences[uid]
+            if record[1] >= self.params.experience_max:
+                # Halving keeps the success rate, rather than wrapping around
+                record //= 2
+        if success:
+            record[0] += 1
+        record[1] += 1
+
+    def prune(self, actor_list):
+        """ Forgets vendors that are no longer trading """
+        live = {actor.uid for actor in actor_list}
+        for uid in [uid for uid in self.experiences if uid not in live]:
+            del self.experiences[uid]
+            self.distances.pop(uid, None)
+
 
     def choose_best(self, actor_list):
         """ UCB formula to decide best actor to buy from """
         assert len(actor_list) > 0
+        if len(self.experiences) > 2*len(actor_list) + 10: # Many vendors have gone
+            self.prune(actor_list)
+        discount = self.params.discount
+        log_N = math.log(max(self.discounted_N, 1) if discount < 1 else self.N or 1)
         choices = []
         for actor in actor_list:
             actor_id = actor.uid # This might be a new actor in the system
             if not (actor_id in self.experiences):
                 # Start tracking the new actor
-                self.experiences[actor_id] = np.zeros(2, dtype=np.int16)
+                self.experiences[actor_id] = self.new_experience()
             if not (actor_id in self.distances):
                 # We might have inherited experiences, but not the distance
                 self.distances[actor_id] = self.distance_to(actor.position)
 
-            dist_cont = Actor.distance_parameter*self.distances[actor_id]
+            dist_cont = self.params.distance_parameter*self.distances[actor_id]
 
-            xn, n = self.experiences[actor_id]
+            record = self.experiences[actor_id]
+            xn, n = record[0], record[1]
 
             if n != 0:
                 x = xn / n
-                exp = Actor.explore_parameter*math.sqrt( 2*math.log(self.N)/n )
+                if discount < 1: # Only the weight of the trials has decayed
+                    n *= discount**(self.N - record[2])
+                exp = self.params.explore_parameter*math.sqrt( 2*log_N/n )
                 ucb = x + exp
 
 
             else:
                 ucb = 1.5 # avoiding division by 0
             #       trust - distance -  price
-            total = ucb - dist_cont - Actor.cost_parameter*actor.price
+            total = ucb - dist_cont - self.params.cost_parameter*actor.price
             choices.append(total)
         self.N += 1
+        if discount < 1:
+            self.discounted_N = self.discounted_N*discount + 1
 
-        consider = min(Actor.top_n, len(actor_list))
+        if self.params.adaptive_top_n:
+            best = self.adaptive_best(actor_list, choices)
+        else:
+            best = self.top_n_best(actor_list, choices)
+
+        result, function = self.buy_from(best) # specific to class
+        if result == None:
+            return function
+        self.record_trial(best.uid, result == 1) # always increase n, and xn if positive
+
+        return function
+
+    def top_n_best(self, actor_list, choices):
+        """ The best of the top_n choices that has stock """
+        consider = min(self.params.top_n, len(actor_list))
         top_n = np.argpartition(choices, range(len(choices)-consider,
                                     len(choices)))[len(choices)-consider:]
 
@@ -246,25 +474,98 @@ class Actor():
                 debug("{} number {} has supply {}".format(t, dep,
                                                         actor_list[dep].supply))
             raise AttributeError("Best {} were all sold out".format(top_n))
+        return best
 
+    def adaptive_best(self, actor_list, choices):
+        """
+        Same as top_n_best, but only ranks as many candidates as this class of
+        actor has needed lately, starting from the single best. If those are
+        all out of stock, the ranking is doubled (up to top_n) and carries on
+        from where it stopped
+        """
+        kind = self.__class__.__name__
+        choices = np.asarray(choices)
+        n = len(choices)
+        limit = min(self.params.top_n, n)
+        width = min(self.watcher.candidate_width(kind, self.params.min_top_n,
+                                                    self.params.top_n), limit)
+        seen = 0
+        widened = False
+        while True:
+            if width == 1:
+                ranked = [int(np.argmax(choices))]
+            else:
+                top = np.argpartition(choices, n - width)[n - width:]
+                ranked = top[np.argsort(choices[top])[::-1]]
+            if seen == 0:
+                self.watcher.inform_choice(actor_list[ranked[0]].uid)
+
+            for dep in ranked[seen:]:
+                if actor_list[dep].supply >= self.min_purchase:
+                    self.watcher.inform_selection(kind, seen, width, widened)
+                    return actor_list[dep]
+                self.watcher.inform_oos()
+                seen += 1
 
-        result, function = self.buy_from(best) # specific to class
-        if result == None:
-            return function
-        if result == 1: # If it was positive, increase xn
-            self.experiences[best.uid][0] += 1
-        self.experiences[best.uid][1] += 1 # always increase n
-
-        return function
+            if width == limit:
+                raise AttributeError("Best {} were all sold out".format(list(ranked)))
+            width = min(2*width, limit)
+            widened = True
 
     def make_vendor_link(self, old, new):
         # Initialises the actor's trust in the new vendor based on their trust
         # in the old one
         # However, we are `less sure` about this value since it a new vendor
-        self.experiences[new] = np.array( [
-            np.int16(np.ceil(self.experiences[old][0]/2)),
-            np.int16(np.ceil(self.experiences[old][1]/2))
-        ])
+        if self.params.discount < 1:
+            record = self.current_experience(old)
+            self.experiences[new] = np.array([np.ceil(record[0]/2), np.ceil(record[1]/2), self.N])
+            return
+        record = self.experiences[old]
+        self.experiences[new] = np.ceil(record/2).astype(record.dtype)
+
+
+class PatientPool():
+    """
+    This class holds a population of patients as an array of positions, and
+    only creates a Patient object the first time one is needed. Patients that
+    have never been used have no experiences yet, so creating them late is the
+    same as creating them up front
+    """
+
+    def __init__(self, positions, system_size, watcher, params=None):
+        self.positions      = np.asarray(positions, dtype=np.float64)
+        self.system_size    = system_size
+        self.watcher        = watcher
+        self.params         = params
+        self.actors         = {} # Patients created so far, by index
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        patient = self.actors.get(i)
+        if patient is None:
+            if i < 0:
+                i += len(self.positions)
+            x, y = self.positions[i]
+            patient = Patient(i, self.system_size, self.watcher, (float(x), float(y)),
+                                self.params)
+            self.actors[i] = patient
+        return patient
+
+    def __iter__(self):
+        for i in range(len(self.positions)):
+            yield self[i]
+
+    def materialized(self):
+        """ The patients that have been created so far """
+        return self.actors.values()
+
+    def make_vendor_link(self, old, new):
+        # Patients that have not been created have no experience to pass on
+        for patient in self.actors.values():
+            if old in patient.experiences:
+                patient.make_vendor_link(old, new)
 
 
 class Patient(Actor):
@@ -272,8 +573,8 @@ class Patient(Actor):
     This is the class to model each patient
     """
 
-    def __init__(self, uid, system_size, watcher, position=(0,0)):
-        super().__init__(position, uid, system_size, watcher)
+    def __init__(self, uid, system_size, watcher, position=(0,0), params=None):
+        super().__init__(position, uid, system_size, watcher, params=params)
         return
 
     def __str__(self):
@@ -294,7 +595,8 @@ class Patient(Actor):
     def take(self, medicine):
         """ This can be extended for more medicine types """
         # TODO: Add in placebo effect
-        return (medicine - rand()) > 0
+        outcomes = self.params.outcomes
+        return (medicine - (rand() if outcomes is None else outcomes.uniform())) > 0
 
 
 class Seller(Actor):
@@ -302,22 +604,24 @@ class Seller(Actor):
     This is the class to model a seller of medicine
     """
 
-    def __init__(self, uid, system_size, watcher, dynam_price=False, position=(0,0), init_supply=0):
-        super().__init__(position, uid, system_size, watcher, dynam_price)
+    def __init__(self, uid, system_size, watcher, dynam_price=False, position=(0,0), init_supply=0, params=None,
+                    cash=None, price=None, quality=None, strategy=None):
+        super().__init__(position, uid, system_size, watcher, dynam_price, params)
 
         # Initial stock and cash
         self.supply = init_supply
-        self.cash   = 30 + rand()
+        self.cash   = 30 + rand() if cash is None else cash
 
         self.min_purchase = 10 # Overwrites '1' from parent class
         self.expansion_amount = 50 # When we have 2* this, we can expand
         self.num_out = 0 # Keep track of the number of times we make no sales
 
-        # Initial price and quality are random
-        self.price      = rand() + 1
-        self.strategy   = rand()  # He uses this as a multiplier for the trust
+        # Initial price and quality are random, unless they are given
+        self.price      = rand() + 1 if price is None else price
+        self.strategy   = rand() if strategy is None else strategy
+                                    # He uses this as a multiplier for the trust
                                     # metric, not sure if I need it.
-        self.quality    = rand()
+        self.quality    = rand() if quality is None else quality
 
         return
 
@@ -332,7 +636,7 @@ class Seller(Actor):
     def out_of_stock(self):
         if self.dynamic_price:
             debug("Seller increased their price")
-            self.price += Actor.epsilon*rand()
+            self.price += self.params.epsilon*rand()
 
     def make_purchase(self):
         #debug("Seller selling 1, supply: {} before" .format(self.supply))
@@ -343,6 +647,15 @@ class Seller(Actor):
             self.out_of_stock()
         return self.price # in case we want patients to have money
 
+    def make_purchases(self, count):
+        """ Sells count units at once, with the same effect as count sales """
+        self.supply -= count
+        self.cash += self.price*count
+        self.watcher.inform_sales(self, count)
+        if self.supply < 1:
+            self.out_of_stock()
+        return self.price
+
     def buy_from(self, supplier):
         # Sellers want to buy as much as possible
         amount = int(min(np.floor(self.cash/supplier.price), supplier.supply))
@@ -366,7 +679,7 @@ class Seller(Actor):
             return result, function
         else: # We ran out of money
             self.num_out += 1
-            if self.num_out > Actor.bust_number:
+            if self.num_out > self.params.bust_number:
                 # We have gone bust
                 return None, "End"
             else:
@@ -377,16 +690,17 @@ class Seller(Actor):
         """ A method to make a new seller from this one's properties """
         experiences = copy.deepcopy(self.experiences)
         quality = self.quality
-        price = abs(min((self.price + Actor.epsilon*(rand()-0.5)), 1.0))
+        price = abs(min((self.price + self.params.epsilon*(rand()-0.5)), 1.0))
         N = self.N
         supply = self.expansion_amount
         new_seller = Seller(uid, self.system_size, self.watcher,
-                                self.dynamic_price, position, supply)
+                                self.dynamic_price, position, supply, self.params)
         self.supply -= self.expansion_amount
         new_seller.experiences = experiences
         new_seller.quality = quality
         new_seller.price = price
         new_seller.N = N
+        new_seller.discounted_N = self.discounted_N
 
         return new_seller
 
@@ -395,27 +709,29 @@ class Seller(Actor):
 
 
     def test_supply(self, quality): # same as patient for now
-        return (quality - rand()) > 0
+        outcomes = self.params.outcomes
+        return (quality - (rand() if outcomes is None else outcomes.uniform())) > 0
 
 
 class Supplier(Actor):
     """ This is the class to model a wholesaler """
 
-    def __init__(self, uid, system_size, watcher, dynam_price=False, position=(0,0), init_supply=500):
-        super().__init__(position, uid, system_size, watcher, dynam_price)
+    def __init__(self, uid, system_size, watcher, dynam_price=False, position=(0,0), init_supply=500, params=None,
+                    cash=None, price=None, quality=None):
+        super().__init__(position, uid, system_size, watcher, dynam_price, params)
 
         # Initial inventory and cash
         self.supply = init_supply
-        self.cash   = rand()
+        self.cash   = rand() if cash is None else cash
         self.expansion_amount = 500
         self.num_out = 0 # Keep track of how many times we don't make sales
 
-        # Start with random quality
-        self.quality = rand()
+        # Start with random quality, unless it is given
+        self.quality = rand() if quality is None else quality
         self.strat  = self.quality
 
         # Initial cost random
-        self.price = 1.0 + 0.25*rand()
+        self.price = 1.0 + 0.25*rand() if price is None else price
 
         return
 
@@ -431,12 +747,13 @@ class Supplier(Actor):
     def out_of_stock(self):
         if self.dynamic_price:
             debug("Supplier increased their price")
-            self.price += Actor.epsilon*rand()
+            self.price += self.params.epsilon*rand()
 
     def make_purchase(self, amount):
 
         self.supply -= amount
         self.cash += self.price*amount
+        self.watcher.inform_wholesale(self)
         if self.supply < 1:
             self.out_of_stock()
         return self.price
@@ -462,7 +779,7 @@ class Supplier(Actor):
 
             self.watcher.inform_no_sup_sales(self.uid)
             self.num_out += 1
-            if self.num_out > Actor.bust_number:
+            if self.num_out > self.params.bust_number:
                 # We have gone bust
                 return "End"
 
@@ -471,10 +788,10 @@ class Supplier(Actor):
         """ A method to make a new supplier from this one's properties """
         quality = self.quality
         price = self.price
-        strategy = abs(min((self.strat + Actor.epsilon*(rand()-0.5)), 1.0))
+        strategy = abs(min((self.strat + self.params.epsilon*(rand()-0.5)), 1.0))
         supply = self.expansion_amount
         new_supplier = Supplier(uid, self.system_size, self.watcher,
-                                    self.dynamic_price, position, supply)
+                                    self.dynamic_price, position, supply, self.params)
         self.supply -= self.expansion_amount
         new_supplier.quality = quality
         new_supplier.price = price
@@ -0,0 +1,208 @@
+"""
+This file implements streaming aggregation of ensembles of simulation runs.
+
+Each finished run is folded into running per-timestep statistics and then
+discarded, so the memory used does not grow with the number of runs:
+    - mean and variance per timestep, using Welford's algorithm
+    - a fixed-bin histogram per timestep, from which quantiles are estimated
+    - a bounded reservoir of whole runs, for plotting individual trajectories
+"""
+import numpy as np
+
+
+def hold(run, length=None):
+    """ Extends a shorter run to length samples by holding its final value """
+    run = np.asarray(run, dtype=np.float64)
+    if length is not None and 0 < len(run) < length:
+        run = np.concatenate( (run, np.full(length - len(run), run[-1])) )
+    return run
+
+
+class EnsembleAggregator():
+    """
+    This class accumulates statistics over runs of mean quality (or any other
+    bounded observable) sampled at the same timesteps
+    """
+
+    def __init__(self, reservoir_size=20, bins=100, value_range=(0., 1.), seed=None):
+        self.reservoir_size = reservoir_size
+        self.bins           = bins
+        self.low, self.high = value_range
+        self.rng            = np.random.default_rng(seed)
+
+        self.num_runs   = 0
+        self.count      = np.zeros(0, dtype=np.int64)   # Runs seen per timestep
+        self.mean       = np.zeros(0)
+        self.m2         = np.zeros(0)                   # Sum of squared deviations
+        self.histogram  = np.zeros((0, bins), dtype=np.uint32)
+        self.reservoir  = []
+
+    def __len__(self):
+        return len(self.count)
+
+    def grow(self, length):
+        """ Extends the per-timestep arrays to cover at least length samples """
+        extra = length - len(self.count)
+        if extra <= 0:
+            return
+        self.count      = np.concatenate( (self.count, np.zeros(extra, dtype=np.int64)) )
+        self.mean       = np.concatenate( (self.mean, np.zeros(extra)) )
+        self.m2         = np.concatenate( (self.m2, np.zeros(extra)) )
+        self.histogram  = np.concatenate( (self.histogram,
+                                np.zeros((extra, self.bins), dtype=np.uint32)) )
+
+    def add(self, run, hold_to=None):
+        """
+        Folds one run's series into the statistics. Runs of different lengths
+        are allowed: each timestep counts the runs that reached it. If hold_to
+        is given, a shorter run (e.g. one stopped on convergence) is extended
+        to that many samples by holding its final value
+        """
+        stored = np.asarray(run, dtype=np.float64)
+        run = hold(stored, hold_to)
+        n = len(run)
+        self.grow(n)
+
+        # Welford's update, vectorised over timesteps
+        self.count[:n] += 1
+        delta = run - self.mean[:n]
+        self.mean[:n] += delta / self.count[:n]
+        self.m2[:n] += delta * (run - self.mean[:n])
+
+        scaled = (run - self.low) / (self.high - self.low) * self.bins
+        index = np.clip(scaled.astype(np.int64), 0, self.bins - 1)
+        self.histogram[np.arange(n), index] += 1
+
+        # Reservoir sampling (Algorithm R) of whole runs
+        self.num_runs += 1
+        if len(self.reservoir) < self.reservoir_size:
+            self.reservoir.append(stored)
+        else:
+            slot = self.rng.integers(self.num_runs)
+            if slot < self.reservoir_size:
+                self.reservoir[slot] = stored
+
+    def variance(self, ddof=1):
+        """ Variance of the runs at each timestep """
+        denominator = np.maximum(self.count - ddof, 1)
+        return np.where(self.count > ddof, self.m2 / denominator, 0.)
+
+    def std(self, ddof=1):
+        return np.sqrt(self.variance(ddof))
+
+    def stderr(self):
+        """ Standard error of the mean at each timestep """
+        return self.std() / np.sqrt(np.maximum(self.count, 1))
+
+    def quantile(self, q):
+        """
+        Estimates the q-th quantile at each timestep, interpolating linearly
+        within the histogram bin that contains it
+        """
+        cumulative = np.cumsum(self.histogram, axis=1)
+        target = q * self.count
+        # First bin whose cumulative count reaches the target
+        index = np.sum(cumulative < target[:, None], axis=1)
+        index = np.clip(index, 0, self.bins - 1)
+
+        steps = np.arange(len(self.count))
+        below = np.where(index > 0, cumulative[steps, np.maximum(index - 1, 0)], 0)
+        in_bin = self.histogram[steps, index]
+        fraction = np.where(in_bin > 0, (target - below) / np.maximum(in_bin, 1), 0.)
+
+        width = (self.high - self.low) / self.bins
+        return self.low + (index + np.clip(fraction, 0., 1.)) * width
+
+
+class MetricHistory():
+    """
+    This class keeps a per-step metric in constant memory. Values are stored
+    in order until capacity is reached, then every pair of neighbouring values
+    is replaced by its mean, and from then on each stored value is the mean of
+    twice as many samples. Very long runs are therefore kept at a resolution
+    that coarsens as they go on, rather than in full
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity   = capacity - capacity % 2 # Pairs must divide it exactly
+        self.data       = np.zeros(self.capacity)
+        self.size       = 0     # Values stored
+        self.stride     = 1     # Samples per stored value
+        self.pending    = 0.    # Sum of the samples towards the next value
+        self.num_pending = 0
+        self.count      = 0     # Samples seen
+        self.last       = 0.    # The latest sample
+
+    def append(self, value):
+        if self.size == self.capacity and self.num_pending == 0:
+            self.compact()
+        self.count += 1
+        self.last = value
+        self.pending += value
+        self.num_pending += 1
+        if self.num_pending < self.stride:
+            return
+        self.data[self.size] = self.pending / self.num_pending
+        self.size += 1
+        self.pending = 0.
+        self.num_pending = 0
+
+    def compact(self):
+        """ Halves the resolution, to make room for as many values again """
+        half = self.size // 2
+        self.data[:half] = (self.data[0:2*half:2] + self.data[1:2*half:2]) / 2
+        self.size = half
+        self.stride *= 2
+
+    def hold(self, count):
+        """
+        Appends the latest sample again until count samples have been seen, so
+        that a run that stopped early is held at its final value before it is
+        compacted, as hold() does for a run kept in full
+        """
+        if self.count == 0:
+            return
+        while self.count < count:
+            if self.num_pending == 0 and self.size < self.capacity:
+                # Whole values at the current stride, without appending each sample
+                whole = min(self.capacity - self.size, (count - self.count) // self.stride)
+                if whole > 0:
+                    self.data[self.size:self.size + whole] = self.last
+                    self.size += whole
+                    self.count += whole*self.stride
+                    continue
+            self.append(self.last)
+
+    def stored(self, count):
+        """ How many values an empty history of this capacity holds after count samples """
+        size, stride = 0, 1
+        while count > (self.capacity - size)*stride:
+            count -= (self.capacity - size)*stride
+            size, stride = self.capacity // 2, stride*2
+        return size + count // stride
+
+    def values(self):
+        return self.data[:self.size].copy()
+
+    def steps(self, every=1):
+        """
+        The sample number each value starts at, times every (the number of
+        steps between samples)
+        """
+        return np.arange(self.size)*self.stride*every
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __getitem__(self, i):
+        return self.values()[i]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.values() if dtype is None else self.values().astype(dtype)
@@ -1,5 +1,5 @@
 import numpy as np
-import time
+import queue
 import sys
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
@@ -8,13 +8,9 @@ from matplotlib.patches import Ellipse
 import logging
 from pprint import pprint
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='(%(threadName)-14s) %(message)s',
-                    )
-
 class Animator():
 
-    def __init__(self, plot_queue, callback_pipe):
+    def __init__(self, plot_queue, callback_pipe, replay=None):
 
         self.queue = plot_queue
         self.callback_pipe = callback_pipe
@@ -22,7 +18,16 @@ class Animator():
 
         self.pause = False
 
-        data = plot_queue.get()
+        # When replaying a recording, frames are read from a TrajectoryReader
+        # instead of the plot queue
+        self.replay = replay
+        self.frame = 0
+        if replay is not None:
+            if len(replay) == 0:
+                raise ValueError("The recording in {} has no frames".format(replay.directory))
+            data = replay.plot_data(0, initial=True)
+        else:
+            data = plot_queue.get()
         if len(data) == 7:
             self.init_map(data)
         elif len(data) == 4:
@@ -121,12 +126,36 @@ class Animator():
         plt.scatter(supx, supq, color='red', s=200, picker=5, label="Suppliers")
         #self.ax_array.add_line(Q_line)
 
+    def show_frame(self, frame):
+        """ Draws a frame of the recording being replayed """
+        self.frame = max(0, min(frame, len(self.replay) - 1))
+        data = self.replay.plot_data(self.frame)
+        if len(data) == 6:
+            result = self.update_map(data)
+        else:
+            result = self.update_line(data)
+        self.ax_array.set_title("Step {} (frame {}/{})".format(
+            self.replay.step(self.frame), self.frame + 1, len(self.replay)))
+        return result
+
+    def update_replay(self, i):
+        if self.pause:
+            return
+        if self.frame >= len(self.replay) - 1:
+            self.replay.refresh() # The recording may still be growing
+            if self.frame >= len(self.replay) - 1:
+                return
+        return self.show_frame(self.frame + 1)
+
     def update(self, i):
         #logging.debug("Trying to update plot")
-        if (self.queue.empty()):
-            time.sleep(0.1)
+        if self.replay is not None:
+            return self.update_replay(i)
+        try:
+            data = self.queue.get_nowait() # Nothing new: keep the current frame
+        except queue.Empty:
+            return
         else:
-            data = self.queue.get()
             #print(data)
             if data == "Stop":
                 self.pause = True
@@ -142,7 +171,14 @@ class Animator():
             self.pause = False
         else:
             self.pause = True
-        self.callback_pipe.send("Pause")
+        if self.callback_pipe is not None:
+            self.callback_pipe.send("Pause")
+
+    def seek(self, frames):
+        """ Moves the replay by a number of frames and pauses it there """
+        self.pause = True
+        self.show_frame(self.frame + frames)
+        self.fig.canvas.draw_idle()
 
 
     def animate(self):
@@ -156,18 +192,26 @@ class Animator():
             x = min(x, self.max_x/2) # 520 the rough width of text box
             y = event.mouseevent.ydata
 
-            if actor_line._label == "Suppliers":
-                self.callback_pipe.send( ["Supplier", ind] )
-                supp = self.callback_pipe.recv()
+            if self.replay is not None:
+                actor = "Supplier" if actor_line._label == "Suppliers" else "Seller"
+                self.ax_array.text(x+1, y+0.01, self.replay.describe(self.frame, actor, ind),
+                                    size=20, bbox=dict(boxstyle="round"))
+                self.fig.canvas.draw_idle()
 
-                self.ax_array.text(x+1, y+0.01, repr(supp), size=20,
+            elif actor_line._label == "Suppliers":
+                self.callback_pipe.send( ("Supplier", ind) )
+                supp = self.callback_pipe.recv() # The supplier's description
+
+                self.ax_array.text(x+1, y+0.01, supp, size=20,
                                     bbox=dict(boxstyle="round"))
+                self.fig.canvas.draw_idle()
 
             else:
-                self.callback_pipe.send( ["Seller", ind] )
+                self.callback_pipe.send( ("Seller", ind) )
                 sell = self.callback_pipe.recv()
-                self.ax_array.text(x+1, y+0.01, repr(sell), size=20,
+                self.ax_array.text(x+1, y+0.01, sell, size=20,
                             backgroundcolor='cyan', bbox=dict(boxstyle="round"))
+                self.fig.canvas.draw_idle()
 
 
         def on_key(event):
@@ -180,8 +224,15 @@ class Animator():
                 else:
                     self.update_line(self.data)
 
+            if self.replay is not None: # Seek controls
+                moves = {"right": 1, "left": -1, "up": 100, "down": -100,
+                         "home": -len(self.replay), "end": len(self.replay)}
+                if event.key in moves:
+                    self.seek(moves[event.key])
+
         def stop_sim(event):
-            self.callback_pipe.send("Stop")
+            if self.callback_pipe is not None:
+                self.callback_pipe.send("Stop")
             logging.debug("Stopping animator")
             sys.exit()
 
@@ -0,0 +1,233 @@
+"""
+This file runs many independent replicates of a small simulation in lockstep
+within one process.
+
+Every piece of state carries a leading batch dimension: patient experiences are
+(B, ni, nj), seller supply, quality and price are (B, nj), and so on. Actors
+still act one at a time within a replicate, in a random order, exactly as in
+Simulation.time_step_sto, but each action is carried out for all B replicates
+with a single NumPy operation. This removes most of the per-replicate Python
+overhead for configurations like the default 1000/100/10.
+
+Dynamic numbers of actors are not supported, since replicates would then have
+different numbers of sellers and suppliers.
+"""
+import numpy as np
+
+from actors import Environment, Parameters
+
+
+class BatchedSimulation():
+    """
+    This class holds the state of B replicates of the model as arrays
+    """
+
+    def __init__(self, batch, ni=1000, nj=100, nk=10, env_file=None, dynam_price=False,
+                    dynam_actors=False, params=None, seed=None):
+        if dynam_actors:
+            raise ValueError("Batched simulations do not support dynamic actors")
+
+        self.B  = batch
+        self.ni = ni
+        self.nj = nj
+        self.nk = nk
+        self.dynamic_price  = dynam_price
+        self.params         = params if params is not None else Parameters()
+        self.rng            = np.random.default_rng(seed)
+        self.b              = np.arange(batch) # Replicate index, for fancy indexing
+
+        if env_file:
+            self.environment = Environment(env_file)
+            self.system_size = self.environment.system_size
+        else:
+            self.environment = None
+            self.system_size = ni # 1D
+
+        rand = self.rng.random
+        patient_pos     = self.positions(ni, 1.0)
+        seller_pos      = self.positions(nj, np.floor(ni/nj))
+        supplier_pos    = self.positions(nk, np.floor(ni/nk))
+        self.patient_dist   = self.distances(patient_pos, seller_pos)
+        self.seller_dist    = self.distances(seller_pos, supplier_pos)
+
+        # Patients: successes and trials for each seller, and total trials
+        self.patient_succ   = np.zeros((batch, ni, nj), dtype=np.int32)
+        self.patient_trials = np.zeros((batch, ni, nj), dtype=np.int32)
+        self.patient_N      = np.zeros((batch, ni), dtype=np.int64)
+
+        # Sellers, initialised as in Seller.__init__
+        self.seller_supply  = np.zeros((batch, nj))
+        self.seller_cash    = 30 + rand((batch, nj))
+        self.seller_price   = rand((batch, nj)) + 1
+        self.seller_quality = rand((batch, nj))
+        self.seller_succ    = np.zeros((batch, nj, nk), dtype=np.int32)
+        self.seller_trials  = np.zeros((batch, nj, nk), dtype=np.int32)
+        self.seller_N       = np.zeros((batch, nj), dtype=np.int64)
+        self.seller_num_out = np.zeros((batch, nj), dtype=np.int64)
+
+        # Suppliers, initialised as in Supplier.__init__
+        self.supplier_supply    = np.full((batch, nk), 500.)
+        self.supplier_cash      = rand((batch, nk))
+        self.supplier_quality   = rand((batch, nk))
+        self.supplier_strat     = self.supplier_quality.copy()
+        self.supplier_price     = 1.0 + 0.25*rand((batch, nk))
+        self.supplier_num_out   = np.zeros((batch, nk), dtype=np.int64)
+
+        self.reset_watcher()
+        self.mean_quality_list = []
+
+        # Sellers start with cash, so they buy in order before the first step
+        for j in range(nj):
+            self.seller_buy(np.full(batch, j))
+
+    def positions(self, n, ratio):
+        """ Draws (B, n, 2) positions, as Simulation.set_positions does """
+        if self.environment:
+            return self.environment.get_positions(self.B*n, self.rng).reshape(self.B, n, 2)
+        x = np.arange(n)*ratio + self.rng.random((self.B, n))
+        return np.stack( (x, self.rng.random((self.B, n))), axis=2 )
+
+    def distances(self, a, b):
+        """ Periodic distances from every a to every b, per replicate """
+        diff = np.abs(a[:, :, None, :] - b[:, None, :, :])
+        if not isinstance(self.system_size, list): # 1D case
+            x = diff[..., 0]
+            return np.where(x > self.system_size/2, self.system_size - x, x)
+        size = np.asarray(self.system_size)
+        diff = np.where(diff > size/2, size - diff, diff)
+        return np.sqrt(np.sum(diff**2, axis=-1))
+
+    def reset_watcher(self):
+        self.num_purchases  = np.zeros(self.B, dtype=np.int64)
+        self.quality_sum    = np.zeros(self.B)
+        self.out_of_stock   = np.zeros(self.B, dtype=np.int64)
+
+    def mean_quality(self):
+        """ Mean quality of the purchases since the last reset, per replicate """
+        return np.where(self.num_purchases > 0,
+                        self.quality_sum / np.maximum(self.num_purchases, 1), 0.)
+
+    def ranked_choices(self, succ, trials, N, dist, price):
+        """
+        The UCB scores of Actor.choose_best for one actor per replicate, as the
+        top_n candidates of each replicate in descending order of score
+        """
+        params = self.params
+        with np.errstate(divide='ignore', invalid='ignore'):
+            explore = params.explore_parameter*np.sqrt(
+                2*np.log(np.maximum(N, 1))[:, None]/trials)
+            ucb = np.where(trials != 0, succ/trials + explore, 1.5)
+        totals = ucb - params.distance_parameter*dist - params.cost_parameter*price
+
+        consider = min(params.top_n, totals.shape[1])
+        top = np.argpartition(-totals, consider - 1, axis=1)[:, :consider]
+        order = np.argsort(-np.take_along_axis(totals, top, axis=1), axis=1)
+        return np.take_along_axis(top, order, axis=1)
+
+    def first_in_stock(self, top, supply, min_purchase):
+        """ Picks the first candidate with enough supply in each replicate """
+        in_stock = np.take_along_axis(supply, top, axis=1) >= min_purchase
+        if not in_stock.any(axis=1).all():
+            raise AttributeError("Best {} were all sold out".format(
+                                    top[~in_stock.any(axis=1)][0]))
+        first = np.argmax(in_stock, axis=1)
+        self.out_of_stock += first
+        return top[self.b, first]
+
+    def patient_buy(self, p):
+        """ Patient p[b] of each replicate b buys from their best seller """
+        b = self.b
+        top = self.ranked_choices(self.patient_succ[b, p], self.patient_trials[b, p],
+                                    self.patient_N[b, p], self.patient_dist[b, p],
+                                    self.seller_price)
+        self.patient_N[b, p] += 1
+        chosen = self.first_in_stock(top, self.seller_supply, 1)
+
+        # Seller.make_purchase
+        self.seller_supply[b, chosen] -= 1
+        self.seller_cash[b, chosen] += self.seller_price[b, chosen]
+        quality = self.seller_quality[b, chosen]
+        self.quality_sum += quality
+        self.num_purchases += 1
+        if self.dynamic_price:
+            sold_out = self.seller_supply[b, chosen] < 1
+            self.seller_price[b, chosen] += np.where(
+                sold_out, self.params.epsilon*self.rng.random(self.B), 0.)
+
+        # Patient.take, which is given the price Seller.make_purchase returns
+        better = (self.seller_price[b, chosen] - self.rng.random(self.B)) > 0
+        self.patient_succ[b, p, chosen] += better
+        self.patient_trials[b, p, chosen] += 1
+
+    def seller_buy(self, s):
+        """ Seller s[b] of each replicate b buys from their best supplier """
+        b = self.b
+        top = self.ranked_choices(self.seller_succ[b, s], self.seller_trials[b, s],
+                                    self.seller_N[b, s], self.seller_dist[b, s],
+                                    self.supplier_price)
+        self.seller_N[b, s] += 1
+        chosen = self.first_in_stock(top, self.supplier_supply, 10)
+
+        # Seller.buy_from: as much as the seller can afford
+        price = self.supplier_price[b, chosen]
+        amount = np.minimum(np.floor(self.seller_cash[b, s]/price),
+                            self.supplier_supply[b, chosen])
+        bought = amount > 0
+        amount = np.where(bought, amount, 0.)
+
+        self.seller_num_out[b, s] = np.where(bought, 0, self.seller_num_out[b, s] + 1)
+        self.supplier_supply[b, chosen] -= amount
+        self.supplier_cash[b, chosen] += price*amount
+        # Suppliers keep fixed prices, even with dynamic pricing
+
+        quality = self.supplier_quality[b, chosen]
+        supply = self.seller_supply[b, s]
+        self.seller_cash[b, s] -= amount*price
+        self.seller_quality[b, s] = np.where(bought,
+            (self.seller_quality[b, s]*supply + quality*amount) / np.maximum(supply + amount, 1),
+            self.seller_quality[b, s])
+        self.seller_supply[b, s] = supply + amount
+
+        # Seller.test_supply, only when something was bought
+        better = (quality - self.rng.random(self.B)) > 0
+        self.seller_succ[b, s, chosen] += bought & better
+        self.seller_trials[b, s, chosen] += bought
+
+    def make_meds(self):
+        """ Supplier.make_meds for every supplier of every replicate """
+        has_cash = self.supplier_cash > 1
+        amount = np.where(has_cash, np.floor(self.supplier_cash), 0.)
+        total = self.supplier_supply + amount
+        self.supplier_quality = np.where(has_cash,
+            (self.supplier_supply*self.supplier_quality + amount*self.supplier_strat)
+                / np.maximum(total, 1),
+            self.supplier_quality)
+        self.supplier_supply = total
+        self.supplier_cash -= amount
+        self.supplier_num_out = np.where(has_cash, 0, self.supplier_num_out + 1)
+
+    def time_step_sto(self):
+        """ One step of every replicate, as in Simulation.time_step_sto """
+        n = int(self.ni / 5)
+        patients = np.argsort(self.rng.random((self.B, self.ni)), axis=1)[:, :n]
+        for t in range(n):
+            self.patient_buy(patients[:, t])
+
+        sellers = np.argsort(self.rng.random((self.B, self.nj)), axis=1)
+        for t in range(self.nj):
+            self.seller_buy(sellers[:, t])
+
+        self.make_meds()
+
+    def run(self, num_trials, sample_every=2):
+        """
+        Runs every replicate for num_trials steps, returning their mean quality
+        series as a (B, samples) array, sampled as run_replicate does
+        """
+        for j in range(num_trials):
+            self.time_step_sto()
+            if (j % sample_every == 0):
+                self.mean_quality_list.append(self.mean_quality())
+            self.reset_watcher()
+
+        return np.array(self.mean_quality_list).T.reshape(self.B, -1)
@@ -0,0 +1,148 @@
+"""
+This file implements an on-disk cache of simulation results.
+
+Each replicate is stored under a hash of its full run specification: the
+population sizes, number of timesteps, flags, parameters, seed, the contents of
+the environment file and the source code of the model. Re-running an identical
+specification therefore reads the results back instead of simulating again.
+"""
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+
+# Source files whose contents define the behaviour of a cached run: the model,
+# the Simulation and run_replicate, and everything they call on the way to a
+# stored result (histories, cohorts, early stopping and the stored stats)
+CODE_FILES = ('actors.py', 'aggregate.py', 'cache.py', 'cohort.py', 'convergence.py',
+                'trust.py')
+
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "senhons")
+DEFAULT_MAX_BYTES = 256 * 1024**2
+
+
+def code_version():
+    """ Returns a hash of the model's source code """
+    digest = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in CODE_FILES:
+        with open(os.path.join(here, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def run_spec(ni, nj, nk, num_trials, dynam_price, dynam_actors, env_file=None,
+                params=None, sample_every=2, **extra):
+    """
+    Returns a dictionary describing a run, suitable for hashing. Any extra
+    keyword arguments are included as part of the specification
+    """
+    env = None
+    if env_file:
+        with open(env_file, 'rb') as f:
+            env = hashlib.sha256(f.read()).hexdigest()
+
+    spec = {
+        'ni': ni, 'nj': nj, 'nk': nk, 'num_trials': num_trials,
+        'dynam_price': bool(dynam_price), 'dynam_actors': bool(dynam_actors),
+        'environment': env, 'sample_every': sample_every,
+        'params': params.as_dict() if params is not None else None,
+        'code': code_version(),
+    }
+    spec.update(extra)
+    return spec
+
+
+class ResultCache():
+    """
+    This class stores replicate results on disk, keyed by the hash of the run
+    specification and the replicate's seed. The total size of the cache is
+    kept below max_bytes by evicting the least recently used entries
+    """
+
+    def __init__(self, directory=DEFAULT_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, spec, seed):
+        text = json.dumps(spec, sort_keys=True) + "|seed={}".format(seed)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, spec, seed):
+        """
+        Returns (mean_quality_list, stats) for a cached replicate, or None if it
+        has not been computed yet or its file cannot be read back
+        """
+        path = self.path(self.key(spec, seed))
+        try:
+            with np.load(path) as data:
+                qualities = data['mean_quality_list']
+                stats = {name: data[name].item() for name in data.files
+                            if name != 'mean_quality_list'}
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            return None # Missing, truncated or corrupt entries are recomputed
+
+        os.utime(path) # Mark as recently used
+        return qualities, stats
+
+    def put(self, spec, seed, qualities, **extra_stats):
+        """ Stores a replicate's mean quality list and its summary stats """
+        qualities = np.asarray(qualities, dtype=np.float64)
+        stats = summary_stats(qualities)
+        stats.update(extra_stats)
+
+        path = self.path(self.key(spec, seed))
+        temp = path + ".tmp.npz"
+        np.savez_compressed(temp, mean_quality_list=qualities, **stats)
+        os.replace(temp, path) # Atomic, so readers never see half a file
+        self.evict()
+
+        return stats
+
+    def evict(self):
+        """ Removes the least recently used entries until under max_bytes """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz") or name.endswith(".tmp.npz"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append( (info.st_mtime, info.st_size, path) )
+            total += info.st_size
+
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.directory, name))
+
+
+def summary_stats(qualities):
+    """ Summary statistics kept alongside each cached trajectory """
+    if len(qualities) == 0:
+        return {'mean': 0., 'std': 0., 'final': 0., 'min': 0., 'max': 0.}
+    return {
+        'mean':     float(np.mean(qualities)),
+        'std':      float(np.std(qualities)),
+        'final':    float(qualities[-1]),
+        'min':      float(np.min(qualities)),
+        'max':      float(np.max(qualities)),
+    }
@@ -0,0 +1,267 @@
+"""
+This file implements an aggregated representation of patients for very large
+populations.
+
+Patients in the same spatial cell (a town of the Environment, or a grid cell)
+with similar experience histories behave alike, so they are held as a single
+weighted cohort. Each step, the number of buyers from each cohort is drawn by
+weight, the buyers are served in score order by the cohort's best sellers, and
+the outcomes are drawn as binomials. A cohort then splits into the patients who
+did not buy, and those who bought from each seller and got better or did not.
+
+Cohorts of a cell are merged again when they would choose alike: when they
+rank the same RANKED sellers first, in the same order, and their total trials
+fall in the same geometric bucket (TRIAL_BUCKETS per doubling). A merged
+cohort takes the weighted average of its parts' experiences. Exact histories
+would split a cell back into single patients within a few dozen steps, since
+each purchase makes a new history; merged this way, the cost of a step scales
+with the number of distinct choices rather than with the number of patients.
+
+Since every patient of a cell is placed at the cell's mean position, and
+merged states are averages, the model is approximate; validate() checks it
+against the per-patient path with the equivalence harness.
+
+Cohorts do not support discounted experience, long-run counters or adaptive
+candidate selection.
+"""
+from math import ceil, log, log2
+from optparse import OptionParser
+
+import numpy as np
+
+from actors import periodic_distances
+
+RANKED          = 1     # Cohorts that rank this many sellers alike are merged
+TRIAL_BUCKETS   = 2     # Buckets of total trials per doubling
+
+
+def trial_bucket(n):
+    """ Total trials, in geometric buckets """
+    return int(TRIAL_BUCKETS*log2(n + 1))
+
+
+class Cohort():
+    """ A group of patients in the same cell with the same experiences """
+
+    __slots__ = ('cell', 'weight', 'N', 'experiences')
+
+    def __init__(self, cell, weight, N=0, experiences=None):
+        self.cell           = cell
+        self.weight         = weight
+        self.N              = N             # Total trials of each member
+        self.experiences    = experiences if experiences is not None else {}
+                                            # seller uid -> (successes, trials)
+
+    def key(self, ranking):
+        """ Cohorts with the same key are merged; ranking is their best sellers """
+        return (self.cell, trial_bucket(self.N), ranking)
+
+    def absorb(self, other):
+        """ Takes in another cohort's members, averaging the two states """
+        total = self.weight + other.weight
+        a, b = self.weight / total, other.weight / total
+        experiences = {}
+        for uid in set(self.experiences) | set(other.experiences):
+            xn_a, n_a = self.experiences.get(uid, (0, 0))
+            xn_b, n_b = other.experiences.get(uid, (0, 0))
+            experiences[uid] = (a*xn_a + b*xn_b, a*n_a + b*n_b)
+        self.experiences = experiences
+        self.N = a*self.N + b*other.N
+        self.weight = total
+
+    def after(self, weight, uid, success):
+        """ A new cohort of weight members who bought once more from uid """
+        experiences = dict(self.experiences)
+        xn, n = experiences.get(uid, (0, 0))
+        experiences[uid] = (xn + success, n + 1)
+        return Cohort(self.cell, weight, self.N + 1, experiences)
+
+
+def assign_cells(positions, system_size, environment=None, cell_size=None):
+    """
+    Returns the cell of every position: a grid cell of cell_size if given,
+    otherwise the nearest town of the environment, otherwise cells of width 10
+    along a 1D system
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    if cell_size is None and environment is not None and environment.towns:
+        centres = np.array([(t.x, t.y) for t in environment.towns])
+        sigmas = np.array([(t.sigmax, t.sigmay) for t in environment.towns])
+        scaled = (positions[:, None, :] - centres[None, :, :]) / sigmas[None, :, :]
+        return np.argmin(np.sum(scaled**2, axis=2), axis=1)
+
+    if cell_size is None:
+        cell_size = 10.
+    if not isinstance(system_size, list): # 1D: cells along x only
+        return np.floor(positions[:, 0] / cell_size).astype(np.int64)
+    columns = int(np.ceil(system_size[0] / cell_size)) + 1
+    cells = np.floor(positions / cell_size).astype(np.int64)
+    return cells[:, 1]*columns + cells[:, 0]
+
+
+class CohortPatients():
+    """
+    This class stands in for the list of patients of a Simulation, holding
+    them as weighted cohorts
+    """
+
+    def __init__(self, positions, system_size, watcher, params, environment=None,
+                    cell_size=None, seed=None):
+        self.system_size    = system_size
+        self.watcher        = watcher
+        self.params         = params
+        if seed is None: # Follow the global seed, as the rest of the model does
+            seed = np.random.randint(2**32)
+        self.rng            = np.random.default_rng(seed)
+
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        self.num_patients = len(positions)
+        labels = assign_cells(positions, system_size, environment, cell_size)
+        cells, index, counts = np.unique(labels, return_inverse=True, return_counts=True)
+
+        # Every member of a cell is placed at the cell's mean position
+        self.centres = np.zeros((len(cells), 2))
+        np.add.at(self.centres, index.ravel(), positions)
+        self.centres /= counts[:, None]
+        self.cohorts = [Cohort(c, int(w)) for c, w in enumerate(counts)]
+
+    def __len__(self):
+        return self.num_patients
+
+    def __iter__(self):
+        return iter(self.cohorts)
+
+    def merge(self, cohorts, sellers, rows, distances, prices):
+        """ Combines cohorts that would choose alike """
+        merged = {}
+        uids = [s.uid for s in sellers]
+        ranked = min(RANKED, len(sellers))
+        for cohort in cohorts:
+            if cohort.weight <= 0:
+                continue
+            totals = self.scores(cohort, rows, distances, prices)
+            top = np.argpartition(totals, len(totals) - ranked)[len(totals) - ranked:]
+            key = cohort.key(tuple(uids[i] for i in top[np.argsort(totals[top])[::-1]]))
+            if key in merged:
+                merged[key].absorb(cohort)
+            else:
+                merged[key] = cohort
+        return list(merged.values())
+
+    def make_vendor_link(self, old, new):
+        # As Actor.make_vendor_link, for every member of every cohort
+        for cohort in self.cohorts:
+            if old in cohort.experiences:
+                xn, n = cohort.experiences[old]
+                cohort.experiences[new] = (ceil(xn/2), ceil(n/2))
+
+    def scores(self, cohort, rows, distances, prices):
+        """
+        The choose_best score of every seller, for a cohort's members. rows maps
+        seller uids to their index in the seller list; only the sellers the
+        cohort has tried differ from the untried score
+        """
+        params = self.params
+        ucb = np.full(len(prices), 1.5)
+        explore = params.explore_parameter*np.sqrt(2*log(max(cohort.N, 1)))
+        for uid, (xn, n) in cohort.experiences.items():
+            row = rows.get(uid)
+            if row is not None and n != 0:
+                ucb[row] = xn/n + explore/np.sqrt(n)
+        return (ucb - params.distance_parameter*distances[cohort.cell]
+                    - params.cost_parameter*prices)
+
+    def purchase(self, sellers, n):
+        """
+        n patients, drawn by cohort weight, each buy from their best seller in
+        stock. Returns the number of distinct cohorts afterwards
+        """
+        weights = np.array([c.weight for c in self.cohorts], dtype=np.int64)
+        buyers = self.rng.multivariate_hypergeometric(weights, min(n, weights.sum()),
+                                                        method='marginals')
+        positions = [s.position for s in sellers]
+        distances = [periodic_distances(centre, positions, self.system_size)
+                        for centre in self.centres]
+        prices = np.array([s.price for s in sellers])
+        rows = {s.uid: row for row, s in enumerate(sellers)}
+        consider = min(self.params.top_n, len(sellers))
+
+        result = []
+        for c in self.rng.permutation(len(self.cohorts)):
+            cohort, k = self.cohorts[c], int(buyers[c])
+            if k == 0:
+                result.append(cohort)
+                continue
+
+            totals = self.scores(cohort, rows, distances, prices)
+            top = np.argpartition(totals, len(totals) - consider)[len(totals) - consider:]
+            top = top[np.argsort(totals[top])[::-1]]
+            uid = sellers[top[0]].uid
+            self.watcher.choice_tally[uid] = self.watcher.choice_tally.get(uid, 0) + k
+
+            # Buyers go down the list until they find a seller with stock
+            remaining = k
+            for dep in top:
+                seller = sellers[dep]
+                if seller.supply < 1:
+                    self.watcher.out_of_stock += remaining
+                    continue
+                take = int(min(remaining, np.floor(seller.supply)))
+                # Patient.take is given the price Seller.make_purchase returns
+                price = seller.make_purchases(take)
+                better = int(self.rng.binomial(take, min(max(price, 0.), 1.)))
+                result.append(cohort.after(better, seller.uid, 1))
+                result.append(cohort.after(take - better, seller.uid, 0))
+                remaining -= take
+                if remaining == 0:
+                    break
+            else:
+                raise AttributeError("Best {} were all sold out".format(top))
+
+            cohort.weight -= k
+            result.append(cohort)
+
+        self.cohorts = self.merge(result, sellers, rows, distances, prices)
+        return len(self.cohorts)
+
+
+def validate(ni=1000, nj=100, nk=10, num_trials=200, replicates=10, env_file=None,
+                dynam_price=False, dynam_actors=False, cell_size=None, seed=0, alpha=0.01):
+    """
+    Runs the same configuration with per-patient and cohort patients, and
+    compares every observable of the equivalence harness between them.
+    Returns the output of equivalence.benchmark()
+    """
+    from equivalence import benchmark, object_runner
+
+    config = {'ni': ni, 'nj': nj, 'nk': nk, 'num_trials': num_trials, 'env_file': env_file,
+                'dynam_price': dynam_price, 'dynam_actors': dynam_actors}
+    return benchmark(object_runner(cohorts=True, cell_size=cell_size), config, replicates,
+                        seed, alpha=alpha)
+
+
+def main():
+    from equivalence import report
+
+    parser = OptionParser("Usage: >> python cohort.py [options] [config_file]")
+    parser.add_option("-n", action="store", dest="n_runs", default=200, type="int",
+        help="Use this to specify the number of timesteps per run (default: 200)")
+    parser.add_option("--ni", action="store", default=1000, type="int",
+        help="Use this option to specify the number of patients (default: 1000)")
+    parser.add_option("--nj", action="store", default=100, type="int",
+        help="Use this option to specify the number of sellers (default: 100)")
+    parser.add_option("--nk", action="store", default=10, type="int",
+        help="Use this option to specify the number of suppliers (default: 10)")
+    parser.add_option("--reps", action="store", default=10, type="int",
+        help="Use this option to specify the replicates of each path (default: 10)")
+    parser.add_option("--cell-size", action="store", dest="cell_size", default=None, type="float",
+        help="Use this option to group patients by grid cells of this size")
+
+    (options, args) = parser.parse_args()
+    result = validate(options.ni, options.nj, options.nk, options.n_runs, options.reps,
+                        args[0] if args else None, cell_size=options.cell_size)
+    print(report(result))
+
+
+if __name__ == "__main__":
+    main()
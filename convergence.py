@@ -0,0 +1,72 @@
+"""
+This file implements detection of convergence in a series of mean qualities,
+so that runs can be ended once the market has settled.
+"""
+from collections import deque
+
+import numpy as np
+
+
+class ConvergenceDetector():
+    """
+    This class watches a series of samples and reports when it has settled. The
+    series is considered stationary when, over the last `window` samples, both
+    the least-squares slope (per sample) and the standard deviation are below
+    their tolerances. It has converged once this holds for `patience`
+    consecutive samples
+    """
+
+    def __init__(self, window=50, slope_tol=1e-4, std_tol=0.02, patience=10, min_samples=0):
+        if window < 2:
+            raise ValueError("Window must contain at least two samples")
+        self.window         = window
+        self.slope_tol      = slope_tol
+        self.std_tol        = std_tol
+        self.patience       = patience
+        self.min_samples    = min_samples
+
+        # Centred sample positions, for the least-squares slope
+        self.x = np.arange(window) - (window - 1) / 2.
+        self.x_var = np.sum(self.x**2)
+        self.reset()
+
+    def reset(self):
+        self.samples        = deque(maxlen=self.window)
+        self.num_samples    = 0
+        self.num_stationary = 0
+        self.stop_sample    = None # Sample at which convergence was declared
+
+    def stationary(self):
+        """ Whether the current window looks stationary """
+        if len(self.samples) < self.window:
+            return False
+        y = np.fromiter(self.samples, dtype=np.float64, count=self.window)
+        slope = np.dot(self.x, y - y.mean()) / self.x_var
+
+        return abs(slope) < self.slope_tol and np.std(y) < self.std_tol
+
+    def update(self, value):
+        """ Adds a sample and returns True once the series has converged """
+        if self.stop_sample is not None:
+            return True
+
+        self.samples.append(value)
+        self.num_samples += 1
+
+        if self.stationary():
+            self.num_stationary += 1
+        else:
+            self.num_stationary = 0
+
+        if (self.num_stationary >= self.patience
+                and self.num_samples >= self.min_samples):
+            self.stop_sample = self.num_samples - 1
+            return True
+
+        return False
+
+    def settings(self):
+        """ The detector's configuration, e.g. for inclusion in cache keys """
+        return {'window': self.window, 'slope_tol': self.slope_tol,
+                'std_tol': self.std_tol, 'patience': self.patience,
+                'min_samples': self.min_samples}
@@ -0,0 +1,279 @@
+"""
+This file checks that faster implementations of the model behave the same as
+the reference object-based one.
+
+Since the model is stochastic, two implementations are compared by running
+each for many seeded replicates and testing whether the distributions of their
+observables differ:
+    mean_quality    the Watcher's mean quality, sampled every other step
+    out_of_stock    failed purchases per step
+    num_sellers     sellers alive (only changes with dynamic actors)
+    num_suppliers   suppliers alive (only changes with dynamic actors)
+    final_prices    seller prices at the end (only spread with dynamic prices)
+Series are compared through each run's time average (Kolmogorov-Smirnov and
+Welch tests) and sample by sample (Welch tests, Bonferroni corrected). Final
+prices are pooled over runs and compared with a Kolmogorov-Smirnov test. The
+p-values of all of these tests are then adjusted together with Holm's method,
+so alpha bounds the chance of any false alarm in the whole comparison.
+
+A small market run for longer has more power per second than a large one, so
+the defaults are 200 patients, 20 sellers and 5 suppliers for 300 steps, with
+40 replicates of each implementation.
+
+benchmark() times a candidate against the reference on the same replicates,
+so a speedup is always reported together with whether it changed the model.
+"""
+import math
+from optparse import OptionParser
+import time
+
+import numpy as np
+
+from actors import Parameters
+
+SERIES = ('mean_quality', 'out_of_stock', 'num_sellers', 'num_suppliers')
+
+
+def observe(sim, num_trials, sample_every=2):
+    """ Runs an object-based simulation, recording every observable """
+    record = {name: [] for name in SERIES}
+    for j in range(num_trials):
+        sim.time_step_sto()
+        if (j % sample_every == 0):
+            record['mean_quality'].append(sim.watcher.get_mean_qual())
+            record['out_of_stock'].append(sim.watcher.out_of_stock)
+            record['num_sellers'].append(len(sim.sellers))
+            record['num_suppliers'].append(len(sim.suppliers))
+        sim.watcher.reset()
+
+    record = {name: np.asarray(values, dtype=np.float64) for name, values in record.items()}
+    record['final_prices'] = np.array([seller.price for seller in sim.sellers])
+    return record
+
+
+def object_runner(**options):
+    def runner(config, seeds):
+        from trust import Simulation, seed_rngs
+        runs = []
+        for seed in seeds:
+            seed_rngs(seed)
+            sim = Simulation(config['ni'], config['nj'], config['nk'], config['env_file'],
+                                config['dynam_price'], config['dynam_actors'], **options)
+            runs.append(observe(sim, config['num_trials']))
+        return runs
+    return runner
+
+
+def _parallel_runner(config, seeds):
+    from parallel import PartitionedSimulation
+    runs = []
+    for seed in seeds:
+        with PartitionedSimulation(config['ni'], config['nj'], config['nk'], config['env_file'],
+                                    config['dynam_price'], config['dynam_actors'],
+                                    processes=config.get('processes'), seed=seed) as sim:
+            runs.append(observe(sim, config['num_trials']))
+    return runs
+
+
+def _event_runner(config, seeds):
+    from events import EventSimulation
+    from trust import seed_rngs
+    runs = []
+    for seed in seeds:
+        seed_rngs(seed)
+        sim = EventSimulation(config['ni'], config['nj'], config['nk'], config['env_file'],
+                                config['dynam_price'], config['dynam_actors'])
+        runs.append(observe(sim, config['num_trials']))
+    return runs
+
+
+def _batched_runner(config, seeds):
+    from batched import BatchedSimulation
+    sim = BatchedSimulation(len(seeds), config['ni'], config['nj'], config['nk'],
+                                config['env_file'], config['dynam_price'],
+                                config['dynam_actors'], seed=seeds[0])
+    record = {name: [] for name in SERIES}
+    for j in range(config['num_trials']):
+        sim.time_step_sto()
+        if (j % 2 == 0):
+            record['mean_quality'].append(sim.mean_quality())
+            record['out_of_stock'].append(sim.out_of_stock.astype(np.float64))
+            record['num_sellers'].append(np.full(sim.B, float(sim.nj)))
+            record['num_suppliers'].append(np.full(sim.B, float(sim.nk)))
+        sim.reset_watcher()
+
+    series = {name: np.array(values).T for name, values in record.items()}
+    return [dict({name: series[name][b] for name in SERIES},
+                    final_prices=sim.seller_price[b].copy()) for b in range(sim.B)]
+
+
+# Implementations that can be compared, by name
+RUNNERS = {
+    'reference':    object_runner(),
+    'bulk':         object_runner(bulk=True),
+    'cohort':       object_runner(cohorts=True),
+    'adaptive':     object_runner(params=Parameters(adaptive_top_n=True)),
+    'parallel':     _parallel_runner,
+    'events':       _event_runner,
+    'batched':      _batched_runner,
+}
+
+
+def welch_p(a, b):
+    """
+    Two-sided p-value of Welch's test for equal means, using the normal
+    approximation to the t distribution
+    """
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    se = np.sqrt(a.var(ddof=1)/len(a) + b.var(ddof=1)/len(b))
+    if se == 0:
+        return 1.0 if a.mean() == b.mean() else 0.0
+    z = abs(a.mean() - b.mean()) / se
+    return math.erfc(z / math.sqrt(2))
+
+
+def ks_p(a, b):
+    """
+    Two-sample Kolmogorov-Smirnov statistic and its asymptotic p-value
+    """
+    a, b = np.sort(np.asarray(a, dtype=np.float64)), np.sort(np.asarray(b, dtype=np.float64))
+    if len(a) == 0 or len(b) == 0:
+        return 0., 1.
+    values = np.concatenate( (a, b) )
+    cdf_a = np.searchsorted(a, values, side='right') / len(a)
+    cdf_b = np.searchsorted(b, values, side='right') / len(b)
+    d = float(np.max(np.abs(cdf_a - cdf_b)))
+
+    ne = len(a)*len(b) / (len(a) + len(b))
+    lam = (math.sqrt(ne) + 0.12 + 0.11/math.sqrt(ne)) * d
+    if lam < 1e-3:
+        return d, 1.
+    p = 2*sum((-1)**(k-1) * math.exp(-2*k*k*lam*lam) for k in range(1, 101))
+    return d, min(max(p, 0.), 1.)
+
+
+def holm(pvalues):
+    """ Holm's step-down adjustment of a family of p-values """
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    adjusted = np.empty(len(pvalues))
+    running = 0.
+    for rank, i in enumerate(np.argsort(pvalues, kind='stable')):
+        running = max(running, min(1., (len(pvalues) - rank)*pvalues[i]))
+        adjusted[i] = running
+    return adjusted
+
+
+def compare(reference_runs, candidate_runs, alpha=0.01, tolerance=0.0):
+    """
+    Compares two lists of observed runs. An observable passes if none of its
+    tests rejects at level alpha after the Holm adjustment over every test,
+    or if the difference in its mean is within tolerance. Returns a
+    dictionary of results per observable
+    """
+    results = {}
+    tests = {} # Observable -> raw p-values of its tests
+    for name in SERIES:
+        length = min(min(len(r[name]) for r in reference_runs),
+                        min(len(r[name]) for r in candidate_runs))
+        ref = np.array([r[name][:length] for r in reference_runs])
+        cand = np.array([r[name][:length] for r in candidate_runs])
+
+        ref_avg, cand_avg = ref.mean(axis=1), cand.mean(axis=1)
+        d, p_ks = ks_p(ref_avg, cand_avg)
+        p_mean = welch_p(ref_avg, cand_avg)
+        # Sample by sample, with a Bonferroni correction for the many tests
+        p_steps = min([welch_p(ref[:, t], cand[:, t]) for t in range(length)] or [1.])
+        p_steps = min(1., p_steps*length)
+
+        tests[name] = [p_ks, p_mean, p_steps]
+        results[name] = {'reference': float(ref_avg.mean()), 'candidate': float(cand_avg.mean()),
+                            'difference': float(cand_avg.mean() - ref_avg.mean()), 'ks': d}
+
+    ref_prices = np.concatenate([r['final_prices'] for r in reference_runs])
+    cand_prices = np.concatenate([r['final_prices'] for r in candidate_runs])
+    d, p = ks_p(ref_prices, cand_prices)
+    tests['final_prices'] = [p]
+    diff = float(np.mean(cand_prices) - np.mean(ref_prices)) if len(cand_prices) else 0.
+    results['final_prices'] = {'reference': float(np.mean(ref_prices)) if len(ref_prices) else 0.,
+                                'candidate': float(np.mean(cand_prices)) if len(cand_prices) else 0.,
+                                'difference': diff, 'ks': d}
+
+    adjusted = iter(holm([p for name in results for p in tests[name]]))
+    for name, result in results.items():
+        result['p'] = float(min(next(adjusted) for _ in tests[name]))
+        result['passed'] = result['p'] >= alpha or abs(result['difference']) <= tolerance
+    return results
+
+
+def benchmark(candidate, config, replicates=40, seed=0, reference='reference',
+                alpha=0.01, tolerance=0.0):
+    """
+    Runs the reference and candidate implementations (names in RUNNERS, or
+    runner functions) on the same seeds, returning their timings, the speedup
+    and the result of compare()
+    """
+    seeds = [seed + rep for rep in range(replicates)]
+    timings = {}
+    runs = {}
+    for label, runner in (('reference', reference), ('candidate', candidate)):
+        if isinstance(runner, str):
+            runner = RUNNERS[runner]
+        start = time.perf_counter()
+        runs[label] = runner(config, seeds)
+        timings[label] = time.perf_counter() - start
+
+    results = compare(runs['reference'], runs['candidate'], alpha, tolerance)
+    return {'timings': timings, 'speedup': timings['reference'] / timings['candidate'],
+            'results': results, 'passed': all(r['passed'] for r in results.values())}
+
+
+def report(bench):
+    """ Formats the output of benchmark() as a table """
+    lines = ["{:<14} {:>10} {:>10} {:>10} {:>8} {:>8}  {}".format(
+                "Observable", "Reference", "Candidate", "Diff", "KS D", "p", "")]
+    for name, r in bench['results'].items():
+        lines.append("{:<14} {:>10.4f} {:>10.4f} {:>10.4f} {:>8.3f} {:>8.4f}  {}".format(
+            name, r['reference'], r['candidate'], r['difference'], r['ks'], r['p'],
+            "ok" if r['passed'] else "DIFFERENT"))
+    lines.append("Reference {:.2f}s, candidate {:.2f}s, speedup {:.1f}x: {}".format(
+        bench['timings']['reference'], bench['timings']['candidate'], bench['speedup'],
+        "equivalent" if bench['passed'] else "NOT equivalent"))
+    return "\n".join(lines)
+
+
+def main():
+    parser = OptionParser("Usage: >> python equivalence.py [options] [config_file]")
+    parser.add_option("--candidate", action="append", default=[],
+        help="Implementation to check, one of {} (repeatable)".format(", ".join(sorted(RUNNERS))))
+    parser.add_option("-n", action="store", dest="n_runs", default=300, type="int",
+        help="Use this to specify the number of timesteps per run (default: 300)")
+    parser.add_option("--dp", action="store_true", default=False,
+        help="Use this option to enable dynamic pricing for vendors")
+    parser.add_option("--da", action="store_true", default=False,
+        help="Use this option to enable dynamic numbers of vendors")
+    parser.add_option("--ni", action="store", default=200, type="int",
+        help="Use this option to specify the number of patients (default: 200)")
+    parser.add_option("--nj", action="store", default=20, type="int",
+        help="Use this option to specify the number of sellers (default: 20)")
+    parser.add_option("--nk", action="store", default=5, type="int",
+        help="Use this option to specify the number of suppliers (default: 5)")
+    parser.add_option("--reps", action="store", default=40, type="int",
+        help="Use this option to specify the replicates of each implementation (default: 40)")
+    parser.add_option("--alpha", action="store", default=0.01, type="float",
+        help="Use this option to specify the significance level of the tests (default: 0.01)")
+    parser.add_option("--tolerance", action="store", default=0.0, type="float",
+        help="Use this option to accept differences in means up to this size (default: 0)")
+
+    (options, args) = parser.parse_args()
+    config = {'ni': options.ni, 'nj': options.nj, 'nk': options.nk,
+                'num_trials': options.n_runs, 'env_file': args[0] if args else None,
+                'dynam_price': options.dp, 'dynam_actors': options.da}
+
+    for candidate in options.candidate or ['bulk']:
+        print("== {} ==".format(candidate))
+        print(report(benchmark(candidate, config, options.reps, alpha=options.alpha,
+                                tolerance=options.tolerance)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+This file implements a continuous-time, event-driven version of the model.
+
+Instead of sampling 20% of the patients and then having every seller restock
+and every supplier produce each step, actors only act when they have an event
+due. Events are kept in a priority queue ordered by time:
+    purchase    Patients buy at rate purchase_rate each. These are superposed
+                into a single Poisson stream, and each purchase is made by a
+                patient chosen at random
+    review      A seller restocks from their best supplier. One is scheduled at
+                the next whole time unit after a seller's first sale since their
+                last restock (a periodic review), or after restock_delay if a
+                sale leaves them with less than restock_level in stock
+    produce     A supplier turns cash into stock, at the next whole time unit
+                after a wholesale
+    idle        Sellers and suppliers with no trade for bust_number+1 time
+                units check whether they have gone bust, as they would had they
+                been idle for that many steps
+An actor that nobody buys from therefore costs nothing until its idle check.
+
+One unit of time corresponds to one step of Simulation.time_step_sto, and
+time_step_sto() here advances the clock by one unit. The Watcher is read and
+reset between units exactly as for a stepped simulation, so run_replicate,
+run_sim and record_run work unchanged and give observables on the same grid.
+"""
+import heapq
+import math
+from optparse import OptionParser
+import random
+import time
+
+import numpy as np
+
+from actors import Seller
+from trust import Simulation
+
+
+class EventSimulation(Simulation):
+    """
+    This class runs a Simulation by processing events in time order. It does
+    not support cohort patients
+    """
+
+    def __init__(self, ni=1000, nj=100, nk=10, env_file=None, dynam_price=False, dynam_actors=False,
+                    params=None, bulk=False, purchase_rate=0.2, restock_level=1, restock_delay=0.,
+                    history=None):
+        super().__init__(ni, nj, nk, env_file, dynam_price, dynam_actors, params, bulk=bulk,
+                            history=history)
+
+        self.time           = 0.
+        self.purchase_rate  = purchase_rate # Per patient per unit of time
+        self.restock_level  = restock_level
+        self.restock_delay  = restock_delay
+        self.queue          = []    # (time, sequence, kind, actor)
+        self.sequence       = 0     # Breaks ties in time, in the order events were made
+        self.events         = dict.fromkeys(('purchase', 'review', 'produce', 'idle'), 0)
+
+        self.review_at      = {}    # Seller uid -> time of their pending review
+        self.produce_at     = {}    # Supplier uid -> time of their pending production
+        self.last_active    = {}    # (kind, uid) -> time of last trade
+        self.closed         = set() # (kind, uid) of actors that have gone bust
+
+        self.watcher.on_sale = self.sold
+        self.watcher.on_wholesale = self.wholesold
+
+        for seller in self.sellers:
+            self.watch_idle(seller)
+        for supplier in self.suppliers:
+            self.watch_idle(supplier)
+            if supplier.cash > 1: # Paid for the sellers' initial stock
+                self.wholesold(supplier)
+        self.schedule_purchase()
+
+    @staticmethod
+    def key(actor):
+        return ("seller" if isinstance(actor, Seller) else "supplier", actor.uid)
+
+    def schedule(self, when, kind, actor=None):
+        heapq.heappush(self.queue, (when, self.sequence, kind, actor))
+        self.sequence += 1
+
+    def schedule_purchase(self):
+        rate = self.purchase_rate*len(self.patients)
+        if rate > 0:
+            self.schedule(self.time + random.expovariate(rate), "purchase")
+
+    def watch_idle(self, actor):
+        """ Starts watching for an actor to go bust from inactivity """
+        self.last_active[self.key(actor)] = self.time
+        self.schedule(self.time + self.params.bust_number + 1, "idle", actor)
+
+    def sold(self, seller):
+        """ Called by the Watcher after every retail sale """
+        self.last_active[self.key(seller)] = self.time
+        if seller.supply < self.restock_level:
+            when = self.time + self.restock_delay
+        else:
+            when = math.floor(self.time) + 1 # The next periodic review
+        if self.review_at.get(seller.uid, math.inf) > when:
+            self.review_at[seller.uid] = when
+            self.schedule(when, "review", seller)
+
+    def wholesold(self, supplier):
+        """ Called by the Watcher after every wholesale """
+        self.last_active[self.key(supplier)] = self.time
+        if supplier.uid not in self.produce_at:
+            when = math.floor(self.time) + 1
+            self.produce_at[supplier.uid] = when
+            self.schedule(when, "produce", supplier)
+
+    def time_step_sto(self, n_samples=None):
+        """ Processes every event in the next unit of time """
+        phase_times = dict.fromkeys(('patients', 'sellers', 'suppliers'), 0.)
+        end = math.floor(self.time) + 1
+
+        while self.queue and self.queue[0][0] < end:
+            when, _, kind, actor = heapq.heappop(self.queue)
+            self.time = when
+            began = time.perf_counter()
+            if kind == "purchase":
+                self.purchase()
+                phase_times['patients'] += time.perf_counter() - began
+            elif actor is not None and self.key(actor) not in self.closed:
+                if kind == "review":
+                    self.review(actor, when)
+                elif kind == "produce":
+                    self.produce(actor)
+                else:
+                    self.check_idle(actor)
+                if isinstance(actor, Seller):
+                    phase_times['sellers'] += time.perf_counter() - began
+                else:
+                    phase_times['suppliers'] += time.perf_counter() - began
+
+        self.time = end
+        self.phase_times = phase_times
+        self.steps += 1
+
+    def purchase(self):
+        self.events['purchase'] += 1
+        patient = self.patients[random.randrange(len(self.patients))]
+        patient.choose_best(self.sellers)
+        self.schedule_purchase()
+
+    def review(self, seller, when):
+        if self.review_at.get(seller.uid) != when:
+            return # Replaced by an earlier review
+        del self.review_at[seller.uid]
+        self.events['review'] += 1
+        self.outcome(seller, seller.choose_best(self.suppliers))
+
+    def produce(self, supplier):
+        del self.produce_at[supplier.uid]
+        self.events['produce'] += 1
+        self.outcome(supplier, supplier.make_meds())
+
+    def check_idle(self, actor):
+        """
+        An idle check is due. If the actor has traded since it was scheduled, a
+        new one is made instead; otherwise the actor has been idle for longer
+        than bust_number steps, and tries once more to trade
+        """
+        last = self.last_active.get(self.key(actor), 0.)
+        due = last + self.params.bust_number + 1
+        if due > self.time:
+            self.schedule(due, "idle", actor)
+            return
+
+        self.events['idle'] += 1
+        actor.num_out = self.params.bust_number # As after that many idle steps
+        if isinstance(actor, Seller):
+            function = actor.choose_best(self.suppliers)
+        else:
+            function = actor.make_meds()
+        if self.key(actor) not in self.closed:
+            self.last_active[self.key(actor)] = self.time
+            self.outcome(actor, function)
+            if self.key(actor) not in self.closed:
+                self.schedule(self.time + self.params.bust_number + 1, "idle", actor)
+
+    def outcome(self, actor, function):
+        """ Creates or removes actors, as the seller and supplier phases do """
+        if not (function and self.dynamic_actors):
+            return
+
+        if function == "New":
+            known = len(self.sellers), len(self.suppliers)
+            self.make_new(actor)
+            # The new actor is the last of its list
+            if len(self.sellers) > known[0]:
+                self.watch_idle(self.sellers[-1])
+            if len(self.suppliers) > known[1]:
+                self.watch_idle(self.suppliers[-1])
+
+        if function == "End":
+            actors = self.sellers if isinstance(actor, Seller) else self.suppliers
+            actors.remove(actor)
+            if not isinstance(actor, Seller):
+                self.watcher.forget_supplier(actor.uid)
+            if self.journal is not None:
+                self.journal.bust(self.steps, actor)
+            self.closed.add(self.key(actor))
+            self.last_active.pop(self.key(actor), None)
+
+
+def compare(ni=1000, nj=100, nk=10, num_trials=200, replicates=5, env_file=None,
+                dynam_price=False, dynam_actors=False, seed=0, **options):
+    """
+    Runs the same configuration stepped and event-driven, returning their
+    average mean quality curves, timings and the events processed per unit
+    of time
+    """
+    from trust import run_replicate, seed_rngs
+
+    curves = {}
+    timings = {}
+    events = {}
+    for label in ("stepped", "events"):
+        runs = []
+        start = time.perf_counter()
+        for rep in range(replicates):
+            seed_rngs(seed + rep)
+            if label == "stepped":
+                sim = Simulation(ni, nj, nk, env_file, dynam_price, dynam_actors, bulk=True)
+            else:
+                sim = EventSimulation(ni, nj, nk, env_file, dynam_price, dynam_actors,
+                                        bulk=True, **options)
+            runs.append(np.asarray(run_replicate(sim, num_trials)))
+            if label == "events":
+                for kind, count in sim.events.items():
+                    events[kind] = events.get(kind, 0) + count / (replicates*num_trials)
+        timings[label] = time.perf_counter() - start
+        length = min(len(run) for run in runs)
+        curves[label] = np.mean([run[:length] for run in runs], axis=0)
+
+    return {'stepped': curves['stepped'], 'events': curves['events'], 'timings': timings,
+            'events_per_step': events}
+
+
+def main():
+    parser = OptionParser("Usage: >> python events.py [options] [config_file]")
+    parser.add_option("-n", action="store", dest="n_runs", default=200, type="int",
+        help="Use this to specify the number of time units per run (default: 200)")
+    parser.add_option("--dp", action="store_true", default=False,
+        help="Use this option to enable dynamic pricing for vendors")
+    parser.add_option("--da", action="store_true", default=False,
+        help="Use this option to enable dynamic numbers of vendors")
+    parser.add_option("--ni", action="store", default=1000, type="int",
+        help="Use this option to specify the number of patients (default: 1000)")
+    parser.add_option("--nj", action="store", default=100, type="int",
+        help="Use this option to specify the number of sellers (default: 100)")
+    parser.add_option("--nk", action="store", default=10, type="int",
+        help="Use this option to specify the number of suppliers (default: 10)")
+    parser.add_option("--reps", action="store", default=5, type="int",
+        help="Use this option to specify the replicates of each scheduler (default: 5)")
+    parser.add_option("--rate", action="store", default=0.2, type="float",
+        help="Use this option to specify each patient's purchase rate in the event-driven "
+             "runs (default: 0.2, which matches the stepped 20% sample)")
+
+    (options, args) = parser.parse_args()
+    result = compare(options.ni, options.nj, options.nk, options.n_runs, options.reps,
+                        args[0] if args else None, options.dp, options.da,
+                        purchase_rate=options.rate)
+    length = min(len(result['stepped']), len(result['events']))
+    print("Mean absolute difference of average curves: {:.4f}".format(
+            np.mean(np.abs(result['stepped'][:length] - result['events'][:length]))))
+    print("Stepped {:.2f}s, event-driven {:.2f}s".format(
+            result['timings']['stepped'], result['timings']['events']))
+    print("Events per unit of time: " + ", ".join("{} {:.1f}".format(kind, count)
+            for kind, count in result['events_per_step'].items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+This file implements a journal of vendor churn: every seller and supplier that
+is created or goes bust under dynamic actors, in a compact binary form.
+
+A journal is a directory of append-only shards:
+    shard-00000.bin     records of the RECORD dtype, in the order they happened
+    ...
+    index.json          for each shard: its record count, the steps it covers,
+                        the range of uids born in it, and how many of each
+                        actor type were born and died in it
+The first records are the initial population (kind INITIAL), so population
+sizes can be worked out from the journal alone. Uids only ever increase, so
+the shard in which a uid was born can be found from the index, and lineage
+queries only read the shards holding each ancestor. Population queries use the
+index's running totals up to the first shard they need.
+"""
+import json
+import os
+from optparse import OptionParser
+
+import numpy as np
+
+from actors import Seller
+
+INITIAL, SPAWN, BUST = range(3)
+SELLER, SUPPLIER = range(2)
+KINDS = {INITIAL: "initial", SPAWN: "spawn", BUST: "bust"}
+ACTORS = {SELLER: "seller", SUPPLIER: "supplier"}
+
+RECORD = np.dtype([('step', np.int64), ('kind', np.uint8), ('actor', np.uint8),
+                    ('uid', np.int64), ('parent', np.int64), ('x', np.float64),
+                    ('y', np.float64), ('quality', np.float64), ('price', np.float64),
+                    ('cash', np.float64)])
+
+
+def actor_type(actor):
+    return SELLER if isinstance(actor, Seller) else SUPPLIER
+
+
+def shard_summary(records):
+    """ The index entry for a block of records """
+    summary = {'records': len(records),
+                'first_step': int(records['step'][0]) if len(records) else None,
+                'last_step': int(records['step'][-1]) if len(records) else None}
+    for code, name in ACTORS.items():
+        mine = records[records['actor'] == code]
+        born = mine[mine['kind'] != BUST]
+        summary[name] = {
+            'uids': [int(born['uid'].min()), int(born['uid'].max())] if len(born) else None,
+            'births': int(len(born)),
+            'deaths': int(np.count_nonzero(mine['kind'] == BUST)),
+        }
+    return summary
+
+
+class ChurnJournal():
+    """
+    This class appends churn records to a journal directory, starting a new
+    shard every shard_size records. Records are buffered in memory and written
+    every flush_every records, and whenever the journal is flushed or closed
+    """
+
+    def __init__(self, directory, sim, shard_size=1 << 16, flush_every=1024):
+        self.directory      = directory
+        self.shard_size     = shard_size
+        self.flush_every    = flush_every
+        os.makedirs(directory, exist_ok=True)
+
+        self.shards     = [] # Index entries of finished shards
+        self.current    = np.zeros(0, dtype=RECORD) # Records of the open shard
+        self.buffer     = []
+        self.file       = None
+        self.open_shard()
+
+        for seller in sim.sellers:
+            self.append(sim.steps, INITIAL, seller)
+        for supplier in sim.suppliers:
+            self.append(sim.steps, INITIAL, supplier)
+        self.flush()
+
+    def shard_name(self, number):
+        return "shard-{:05d}.bin".format(number)
+
+    def open_shard(self):
+        self.file = open(os.path.join(self.directory, self.shard_name(len(self.shards))), 'wb')
+        self.current = np.zeros(0, dtype=RECORD)
+
+    def append(self, step, kind, actor, parent=None):
+        self.buffer.append( (step, kind, actor_type(actor), actor.uid,
+                                -1 if parent is None else parent.uid,
+                                actor.position[0], actor.position[1], actor.quality,
+                                actor.price, actor.cash) )
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def spawn(self, step, actor, parent):
+        """ Records a new seller or supplier, set up by parent """
+        self.append(step, SPAWN, actor, parent)
+
+    def bust(self, step, actor):
+        """ Records a seller or supplier going bust """
+        self.append(step, BUST, actor)
+
+    def flush(self):
+        """ Writes buffered records, starting new shards as they fill """
+        records = np.array(self.buffer, dtype=RECORD)
+        self.buffer = []
+        while len(records):
+            room = self.shard_size - len(self.current)
+            block, records = records[:room], records[room:]
+            block.tofile(self.file)
+            self.current = np.concatenate( (self.current, block) )
+            if len(self.current) == self.shard_size:
+                self.file.close()
+                self.shards.append(dict(shard_summary(self.current),
+                                        file=self.shard_name(len(self.shards))))
+                self.open_shard()
+        self.file.flush()
+        self.write_index()
+
+    def write_index(self):
+        shards = list(self.shards)
+        if len(self.current):
+            shards.append(dict(shard_summary(self.current),
+                                file=self.shard_name(len(self.shards))))
+        temp = os.path.join(self.directory, "index.json.tmp")
+        with open(temp, 'w') as f:
+            json.dump({'record': [list(field) for field in RECORD.descr],
+                        'shards': shards}, f)
+        os.replace(temp, os.path.join(self.directory, "index.json"))
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class JournalReader():
+    """
+    This class answers queries on a journal, reading only the shards that a
+    query needs
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.cache = {} # Shard number -> records
+        self.refresh()
+
+    def refresh(self):
+        """ Re-reads the index, picking up shards written since opening """
+        with open(os.path.join(self.directory, "index.json"), 'r') as f:
+            self.shards = json.load(f)['shards']
+        self.cache = {}
+        # Population of each actor type before each shard
+        self.before = {}
+        for name in ACTORS.values():
+            net = [shard[name]['births'] - shard[name]['deaths'] for shard in self.shards]
+            self.before[name] = np.concatenate( ([0], np.cumsum(net)) ).astype(np.int64)
+
+    def shard(self, number):
+        """ The records of one shard, mapped from disk """
+        if number not in self.cache:
+            entry = self.shards[number]
+            self.cache[number] = np.memmap(os.path.join(self.directory, entry['file']),
+                                            dtype=RECORD, mode='r', shape=(entry['records'],))
+        return self.cache[number]
+
+    def shards_between(self, start=None, stop=None):
+        """ The numbers of the shards holding records from steps start to stop """
+        return [n for n, shard in enumerate(self.shards)
+                if (start is None or shard['last_step'] >= start)
+                and (stop is None or shard['first_step'] <= stop)]
+
+    def events(self, start=None, stop=None):
+        """ Every record from steps start to stop (inclusive) """
+        blocks = []
+        for n in self.shards_between(start, stop):
+            records = self.shard(n)
+            keep = np.ones(len(records), dtype=bool)
+            if start is not None:
+                keep &= records['step'] >= start
+            if stop is not None:
+                keep &= records['step'] <= stop
+            blocks.append(np.asarray(records[keep]))
+        return np.concatenate(blocks) if blocks else np.zeros(0, dtype=RECORD)
+
+    def population(self, actor="seller", start=None, stop=None):
+        """
+        The number of sellers (or suppliers) alive after each step from start
+        to stop. Returns (steps, counts)
+        """
+        code = {name: code for code, name in ACTORS.items()}[actor]
+        shards = self.shards_between(start, stop)
+        if not shards:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        records = np.concatenate([np.asarray(self.shard(n)) for n in shards])
+        records = records[records['actor'] == code]
+        change = np.where(records['kind'] == BUST, -1, 1)
+        counts = self.before[actor][shards[0]] + np.cumsum(change)
+
+        # The count after the last record of each step
+        steps = records['step']
+        last = np.append(steps[1:] != steps[:-1], True)
+        steps, counts = steps[last], counts[last]
+        keep = np.ones(len(steps), dtype=bool)
+        if start is not None:
+            keep &= steps >= start
+        if stop is not None:
+            keep &= steps <= stop
+        return steps[keep], counts[keep]
+
+    def birth(self, uid, actor="seller"):
+        """ The record of a seller or supplier being created """
+        code = {name: code for code, name in ACTORS.items()}[actor]
+        for n, shard in enumerate(self.shards):
+            uids = shard[actor]['uids']
+            if uids is not None and uids[0] <= uid <= uids[1]:
+                records = self.shard(n)
+                found = np.nonzero((records['uid'] == uid) & (records['actor'] == code)
+                                    & (records['kind'] != BUST))[0]
+                if len(found):
+                    return records[found[0]]
+        raise KeyError("No {} {} in the journal".format(actor, uid))
+
+    def lineage(self, uid, actor="seller"):
+        """
+        The records of a seller or supplier and its ancestors, from the
+        initial actor it descends from down to itself
+        """
+        line = [self.birth(uid, actor)]
+        while line[-1]['parent'] >= 0:
+            line.append(self.birth(int(line[-1]['parent']), actor))
+        return line[::-1]
+
+
+def describe(record):
+    return "step {:6d} {:7} {:8} {:5d} (parent {:5d}) at ({:7.2f},{:5.2f}) quality {:.3f} price {:.3f} cash {:.2f}".format(
+        int(record['step']), KINDS[int(record['kind'])], ACTORS[int(record['actor'])],
+        int(record['uid']), int(record['parent']), record['x'], record['y'],
+        record['quality'], record['price'], record['cash'])
+
+
+def main():
+    parser = OptionParser("Usage: >> python journal.py [options] <journal directory>")
+    parser.add_option("--population", action="store", default=None,
+        help="Use this option to print the population of 'seller' or 'supplier' over time")
+    parser.add_option("--lineage", action="store", default=None, type="int",
+        help="Use this option to print the ancestry of the seller (or --supplier) with this uid")
+    parser.add_option("--supplier", action="store_true", default=False,
+        help="Use this option with --lineage to look up a supplier")
+    parser.add_option("--start", action="store", default=None, type="int",
+        help="Use this option to limit queries to steps from this one")
+    parser.add_option("--stop", action="store", default=None, type="int",
+        help="Use this option to limit queries to steps up to this one")
+
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("A journal directory is required")
+    reader = JournalReader(args[0])
+
+    if options.population:
+        for step, count in zip(*reader.population(options.population, options.start,
+                                                    options.stop)):
+            print("{:8d} {:6d}".format(step, count))
+    elif options.lineage is not None:
+        for record in reader.lineage(options.lineage,
+                                        "supplier" if options.supplier else "seller"):
+            print(describe(record))
+    else:
+        for record in reader.events(options.start, options.stop):
+            print(describe(record))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+This file accounts for the memory used by a simulation, broken down by what it
+is used for.
+
+memory_report() can be called at any time. MemoryMonitor calls it every few
+steps of a run and can also diff tracemalloc snapshots between samples, so that
+memory that keeps growing (for example from sellers and suppliers being created
+and removed under dynamic actors) shows up with the lines that allocated it.
+"""
+import pickle
+import random
+import sys
+import tracemalloc
+
+CATEGORIES = ('patients', 'patient_experiences', 'patient_distances',
+              'sellers', 'seller_experiences', 'seller_distances',
+              'suppliers', 'supplier_experiences', 'supplier_distances',
+              'watcher_history', 'animator_queue')
+
+
+def dict_bytes(d):
+    """ Size of a dictionary with its keys and values (one level deep) """
+    total = sys.getsizeof(d)
+    for key, value in d.items():
+        total += sys.getsizeof(key) + sys.getsizeof(value)
+    return total
+
+
+def list_bytes(values):
+    if hasattr(values, 'nbytes'): # Arrays and MetricHistory
+        return values.nbytes
+    return sys.getsizeof(values) + sum(sys.getsizeof(v) for v in values)
+
+
+def actor_bytes(actors, sample=None):
+    """
+    Returns (object bytes, experience bytes, distance bytes) for a collection
+    of actors. If sample is given and there are more actors than that, a random
+    sample is measured and scaled up
+    """
+    actors = list(actors)
+    scale = 1.
+    if sample is not None and len(actors) > sample:
+        scale = len(actors) / sample
+        actors = random.sample(actors, sample)
+
+    objects = experiences = distances = 0
+    for actor in actors:
+        objects += sys.getsizeof(actor) + sys.getsizeof(actor.__dict__)
+        experiences += dict_bytes(actor.experiences)
+        distances += dict_bytes(actor.distances)
+    return int(objects*scale), int(experiences*scale), int(distances*scale)
+
+
+def patient_bytes(patients, sample=None):
+    """ As actor_bytes, for any of the ways a Simulation can hold patients """
+    if isinstance(patients, list):
+        return actor_bytes(patients, sample)
+
+    if hasattr(patients, 'cohorts'): # CohortPatients
+        objects = sys.getsizeof(patients.cohorts) + patients.centres.nbytes
+        experiences = 0
+        for cohort in patients.cohorts:
+            objects += sys.getsizeof(cohort)
+            experiences += dict_bytes(cohort.experiences)
+        return objects, experiences, 0
+
+    # PatientPool: the position array plus the patients created so far
+    objects, experiences, distances = actor_bytes(patients.materialized(), sample)
+    return objects + patients.positions.nbytes + dict_bytes(patients.actors), experiences, distances
+
+
+def memory_report(sim, plot_queue=None, frame_bytes=0, history=(), sample=None):
+    """
+    Returns the bytes used by each category of the simulation's state.
+    plot_queue is the Animator's queue, whose backlog is estimated as its
+    length times frame_bytes; history is any other per-step metric lists kept
+    by the caller, counted with the Watcher's history
+    """
+    report = dict.fromkeys(CATEGORIES, 0)
+
+    (report['patients'], report['patient_experiences'],
+        report['patient_distances']) = patient_bytes(sim.patients, sample)
+    (report['sellers'], report['seller_experiences'],
+        report['seller_distances']) = actor_bytes(sim.sellers)
+    (report['suppliers'], report['supplier_experiences'],
+        report['supplier_distances']) = actor_bytes(sim.suppliers)
+
+    watcher = sim.watcher
+    report['watcher_history'] = (list_bytes(watcher.mean_quality_list)
+                                    + dict_bytes(watcher.choice_tally)
+                                    + dict_bytes(watcher.sup_no_sales)
+                                    + sum(list_bytes(h) for h in history))
+
+    if plot_queue is not None:
+        try:
+            report['animator_queue'] = plot_queue.qsize() * frame_bytes
+        except NotImplementedError: # qsize is not available on every platform
+            pass
+
+    return report
+
+
+def frame_size(frame):
+    """ The size of a frame as it is sent through the plot queue """
+    return len(pickle.dumps(frame))
+
+
+def format_report(report):
+    total = sum(report.values())
+    lines = ["{:<22} {:>12}".format("Category", "MB")]
+    for name in CATEGORIES:
+        lines.append("{:<22} {:>12.3f}".format(name, report[name] / 1024**2))
+    lines.append("{:<22} {:>12.3f}".format("total", total / 1024**2))
+    return "\n".join(lines)
+
+
+class MemoryMonitor():
+    """
+    This class samples memory_report every `every` steps of a run. With trace
+    set, it also takes a tracemalloc snapshot at each sample and prints the
+    allocation sites that grew the most since the previous one
+    """
+
+    def __init__(self, every=100, trace=False, top=10, sample=1000):
+        self.every      = every
+        self.trace      = trace
+        self.top        = top
+        self.sample     = sample
+        self.reports    = [] # (step, total bytes)
+        self.snapshot   = None
+
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def due(self, step):
+        return step % self.every == 0
+
+    def record(self, step, sim, plot_queue=None, frame_bytes=0, history=()):
+        report = memory_report(sim, plot_queue, frame_bytes, history, self.sample)
+        self.reports.append( (step, sum(report.values())) )
+        print("Memory at step {}:\n{}".format(step, format_report(report)))
+
+        if self.trace:
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)])
+            if self.snapshot is not None:
+                growth = snapshot.compare_to(self.snapshot, 'lineno')
+                print("Largest allocation changes since the last sample:")
+                for stat in growth[:self.top]:
+                    print("    {}".format(stat))
+            self.snapshot = snapshot
+
+        return report
+
+    def stop(self):
+        if self.trace:
+            tracemalloc.stop()
@@ -0,0 +1,157 @@
+"""
+This file serves live metrics of a running simulation, so that long headless
+jobs can be checked on without a terminal.
+
+The step loop calls MetricsPublisher.publish() after each step, which builds a
+new snapshot dictionary and swaps it in with a single assignment. The server
+runs on a background thread and only ever reads whichever snapshot is current,
+so neither side takes a lock and the step loop is never held up by a request.
+
+Endpoints:
+    /               the current snapshot as JSON (also /json)
+    /metrics        the same values in the Prometheus text format
+The server listens on a local TCP port, or on a Unix socket if given a path.
+"""
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import socketserver
+import stat
+import threading
+import time
+
+
+class MetricsPublisher():
+    """
+    This class holds the latest snapshot of a run's metrics. Steps per second
+    is measured over the interval since the previous publish, smoothed
+    """
+
+    def __init__(self, smoothing=0.9):
+        self.smoothing  = smoothing
+        self.started    = time.time()
+        self.last       = None # (time, step) of the previous publish
+        self.rate       = 0.
+        self.totals     = {} # Total seconds spent in each phase
+        self.progress   = {'replicate': 0, 'replicates': 1}
+        self.snapshot   = {'step': 0}
+
+    def set_progress(self, replicate, replicates):
+        """ Which of a series of runs is being published """
+        self.progress = {'replicate': replicate, 'replicates': replicates}
+        self.last = None # Step counts restart with each replicate
+
+    def publish(self, sim):
+        now = time.perf_counter()
+        step = sim.steps
+        if self.last is not None and now > self.last[0] and step > self.last[1]:
+            rate = (step - self.last[1]) / (now - self.last[0])
+            self.rate = rate if self.rate == 0 else (self.smoothing*self.rate
+                                                        + (1 - self.smoothing)*rate)
+        self.last = (now, step)
+
+        phases = dict(getattr(sim, 'phase_times', {}))
+        for phase, seconds in phases.items():
+            self.totals[phase] = self.totals.get(phase, 0.) + seconds
+
+        watcher = sim.watcher
+        attempts = watcher.num_purchases + watcher.out_of_stock
+        snapshot = {
+            'step':             step,
+            'steps_per_second': self.rate,
+            'uptime':           time.time() - self.started,
+            'mean_quality':     watcher.mean_quality,
+            'purchases':        watcher.num_purchases,
+            'out_of_stock':     watcher.out_of_stock,
+            'out_of_stock_rate': watcher.out_of_stock / attempts if attempts else 0.,
+            'patients':         len(sim.patients),
+            'sellers':          len(sim.sellers),
+            'suppliers':        len(sim.suppliers),
+            'phase_seconds':    phases,
+            'phase_seconds_total': dict(self.totals),
+        }
+        selection = watcher.selection_stats()
+        if selection: # Only with adaptive candidate selection
+            snapshot['candidate_width'] = {kind: s['width'] for kind, s in selection.items()}
+            snapshot['selection_oos_rate'] = {kind: s['oos_rate'] for kind, s in selection.items()}
+            snapshot['selection_widened'] = {kind: s['widened'] for kind, s in selection.items()}
+        snapshot.update(self.progress)
+        self.snapshot = snapshot # A single assignment, so readers never see half of it
+
+
+def prometheus_text(snapshot, prefix="trust"):
+    """ Formats a snapshot in the Prometheus text exposition format """
+    lines = []
+    for name, value in snapshot.items():
+        if isinstance(value, dict):
+            if not value:
+                continue
+            label = 'phase' if name.startswith('phase') else 'kind'
+            lines.append("# TYPE {}_{} {}".format(prefix, name,
+                            "counter" if name.endswith('total') else "gauge"))
+            for key, v in value.items():
+                lines.append('{}_{}{{{}="{}"}} {}'.format(prefix, name, label, key, float(v)))
+        elif isinstance(value, (int, float)):
+            lines.append("# TYPE {}_{} gauge".format(prefix, name))
+            lines.append("{}_{} {}".format(prefix, name, float(value)))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    publisher = None # Set on the subclass made by serve_metrics
+
+    def do_GET(self):
+        snapshot = self.publisher.snapshot # Whatever is current; never waits
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            body = prometheus_text(snapshot).encode()
+            content_type = "text/plain; version=0.0.4"
+        elif path in ('/', '/json'):
+            body = json.dumps(snapshot).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        pass # Requests would otherwise be printed among the run's progress
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+def serve_metrics(publisher, address):
+    """
+    Starts serving a publisher's snapshots on a daemon thread. address is a
+    port number (served on localhost) or a path for a Unix socket. Returns the
+    server, which can be stopped with shutdown()
+    """
+    handler = type('Handler', (MetricsHandler,), {'publisher': publisher})
+    if isinstance(address, int) or str(address).isdigit():
+        server = ThreadingHTTPServer(("127.0.0.1", int(address)), handler)
+        server.daemon_threads = True
+    else:
+        if os.path.exists(address): # A socket left by an earlier run
+            if not stat.S_ISSOCK(os.stat(address).st_mode):
+                raise FileExistsError("{} exists and is not a socket".format(address))
+            os.unlink(address)
+        server = UnixHTTPServer(address, handler)
+
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
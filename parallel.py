@@ -0,0 +1,360 @@
+"""
+This file runs a single large simulation across several processes by splitting
+it into spatial partitions.
+
+Patients are divided between worker processes by town (or by strips of the
+system when there is no environment), and each seller is owned by the
+partition it sits in. With fewer processes than towns, towns are shared out
+so that each partition holds about as many patients. The seller table
+(position, price, quality, supply and uid of every seller) lives in shared
+memory, so every worker can read it. Each step then proceeds as:
+    1. Every worker runs its patients' purchases concurrently. Purchases from
+       sellers the partition owns are made straight away against a local copy
+       of their supply; purchases from other partitions' sellers are sent back
+       as requests.
+    2. The master applies the local sales, then grants or refuses the requests
+       in a fixed order (by partition, then by the order they were made) so the
+       result does not depend on timing. Patients whose request is refused go
+       without this step, as if their seller had sold out.
+    3. Workers update their patients' experience for the granted requests.
+    4. The seller and supplier phases run centrally in the master, as in
+       Simulation, and the seller table is written back to shared memory.
+"""
+import math
+from multiprocessing import Process, Pipe
+from multiprocessing.shared_memory import SharedMemory
+import os
+
+import numpy as np
+
+from actors import periodic_distances
+from trust import Simulation
+
+# Columns of the shared seller table
+X, Y, PRICE, QUALITY, SUPPLY, UID, OWNER = range(7)
+NUM_COLUMNS = 7
+
+
+def town_parts(towns, num_parts):
+    """
+    Shares towns out between num_parts partitions, largest first to whichever
+    partition holds the fewest people so far. Returns the partition of each town
+    """
+    parts = np.zeros(len(towns), dtype=np.int64)
+    load = np.zeros(num_parts)
+    for i in sorted(range(len(towns)), key=lambda i: -towns[i].size):
+        parts[i] = np.argmin(load)
+        load[parts[i]] += towns[i].size
+    return parts
+
+
+def partition_positions(positions, system_size, environment, num_parts):
+    """
+    Assigns each position to a partition: the partition of the nearest town
+    (measured in town standard deviations) if there is an environment,
+    otherwise one of num_parts equal strips along x
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    if environment is not None and environment.towns:
+        centres = np.array([(t.x, t.y) for t in environment.towns])
+        sigmas = np.array([(t.sigmax, t.sigmay) for t in environment.towns])
+        scaled = (positions[:, None, :] - centres[None, :, :]) / sigmas[None, :, :]
+        nearest = np.argmin(np.sum(scaled**2, axis=2), axis=1)
+        return town_parts(environment.towns, num_parts)[nearest]
+
+    width = system_size if not isinstance(system_size, list) else system_size[0]
+    strips = np.floor(positions[:, 0] / width * num_parts).astype(np.int64)
+    return np.clip(strips, 0, num_parts - 1)
+
+
+class TileWorker():
+    """
+    This class holds the patients of one partition as arrays and runs their
+    purchases. Experiences are stored in columns, one per seller uid seen
+    """
+
+    def __init__(self, tile, positions, system_size, params, seed):
+        self.tile           = tile
+        self.positions      = np.asarray(positions, dtype=np.float64)
+        self.system_size    = system_size
+        self.params         = params
+        self.rng            = np.random.default_rng([seed, tile])
+
+        m = len(self.positions)
+        self.N          = np.zeros(m, dtype=np.int64)
+        self.columns    = {} # seller uid -> column of successes/trials
+        self.successes  = np.zeros((m, 0), dtype=np.int32)
+        self.trials     = np.zeros((m, 0), dtype=np.int32)
+        self.pending    = None
+
+    def column(self, uid):
+        """ Returns the experience column for a seller, adding it if new """
+        col = self.columns.get(uid)
+        if col is None:
+            col = len(self.columns)
+            if col >= self.successes.shape[1]:
+                extra = max(8, self.successes.shape[1])
+                pad = np.zeros((len(self.positions), extra), dtype=np.int32)
+                self.successes = np.concatenate( (self.successes, pad), axis=1 )
+                self.trials = np.concatenate( (self.trials, pad), axis=1 )
+            self.columns[uid] = col
+        return col
+
+    def prune(self, live):
+        """ Drops the columns of sellers no longer trading, as Actor.prune does """
+        live = set(int(uid) for uid in live)
+        keep = [uid for uid in self.columns if uid in live]
+        old = [self.columns[uid] for uid in keep]
+        self.successes = self.successes[:, old]
+        self.trials = self.trials[:, old]
+        self.columns = {uid: col for col, uid in enumerate(keep)}
+
+    def link(self, old, new):
+        """ Same as Actor.make_vendor_link, for every patient at once """
+        new_col = self.column(new)
+        if old in self.columns:
+            old_col = self.columns[old]
+            self.successes[:, new_col] = np.ceil(self.successes[:, old_col]/2)
+            self.trials[:, new_col] = np.ceil(self.trials[:, old_col]/2)
+
+    def purchase_phase(self, table):
+        """
+        Runs the purchases of a random 20% of this partition's patients.
+        Returns the sales made from owned sellers (per table row), the requests
+        for other partitions' sellers, the out-of-stock count and the tally of
+        each seller being first choice
+        """
+        params = self.params
+        n_sellers = len(table)
+        if len(self.columns) > 2*n_sellers + 10: # Many sellers have gone
+            self.prune(table[:, UID])
+        cols = np.array([self.column(int(uid)) for uid in table[:, UID]], dtype=np.int64)
+        owned = table[:, OWNER] == self.tile
+        supply = table[:, SUPPLY].copy()
+        cost = params.cost_parameter*table[:, PRICE]
+
+        sales = np.zeros(n_sellers, dtype=np.int64)
+        choices = np.zeros(n_sellers, dtype=np.int64)
+        requests = [] # (patient, row) for sellers owned by other partitions
+        out_of_stock = 0
+        consider = min(params.top_n, n_sellers)
+
+        m = len(self.positions)
+        for p in self.rng.permutation(m)[:int(m / 5)]:
+            dist = periodic_distances(self.positions[p], table[:, X:Y+1], self.system_size)
+            xn = self.successes[p, cols]
+            n = self.trials[p, cols]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                explore = params.explore_parameter*np.sqrt(
+                    2*math.log(max(self.N[p], 1))/n)
+                ucb = np.where(n != 0, xn/n + explore, 1.5)
+            totals = ucb - params.distance_parameter*dist - cost
+            self.N[p] += 1
+
+            top = np.argpartition(totals, n_sellers - consider)[n_sellers - consider:]
+            top = top[np.argsort(totals[top])[::-1]]
+            choices[top[0]] += 1
+
+            for row in top:
+                if supply[row] < 1:
+                    out_of_stock += 1
+                    continue
+                if owned[row]:
+                    supply[row] -= 1
+                    sales[row] += 1
+                    self.record(p, cols[row], table[row, PRICE])
+                else:
+                    requests.append( (p, row) )
+                break
+            else:
+                raise AttributeError("Best {} were all sold out".format(top))
+
+        self.pending = (requests, cols, table[:, PRICE].copy())
+        return sales, [row for p, row in requests], out_of_stock, choices
+
+    def apply_grants(self, granted):
+        """ Patients whose cross-partition request was granted take their medicine """
+        requests, cols, price = self.pending
+        for (p, row), ok in zip(requests, granted):
+            if ok:
+                self.record(p, cols[row], price[row])
+        self.pending = None
+
+    def record(self, p, col, price):
+        # Patient.take is given the price Seller.make_purchase returns. This is
+        # the price at the start of the step, before any sale out raised it
+        if (price - self.rng.random()) > 0:
+            self.successes[p, col] += 1
+        self.trials[p, col] += 1
+
+
+def _worker_main(connection, tile, positions, system_size, params, seed):
+    worker = TileWorker(tile, positions, system_size, params, seed)
+    memory = None
+    table = None
+    try:
+        while True:
+            message = connection.recv()
+            kind = message[0]
+            if kind == "stop":
+                break
+            elif kind == "map":
+                name, capacity = message[1:]
+                if memory is not None:
+                    table = None
+                    memory.close()
+                memory = SharedMemory(name=name)
+                table = np.ndarray((capacity, NUM_COLUMNS), dtype=np.float64,
+                                    buffer=memory.buf)
+            elif kind == "step":
+                n_sellers, links = message[1:]
+                for old, new in links:
+                    worker.link(old, new)
+                try:
+                    connection.send( ("intents",) +
+                                        worker.purchase_phase(table[:n_sellers]) )
+                except AttributeError as error:
+                    connection.send( ("error", str(error)) )
+            elif kind == "grants":
+                worker.apply_grants(message[1])
+                connection.send( ("done",) )
+    finally:
+        table = None
+        if memory is not None:
+            memory.close()
+        connection.close()
+
+
+class PartitionedSimulation(Simulation):
+    """
+    This class runs the patient phase of a Simulation across worker processes,
+    one per partition. It must be closed (or used as a context manager) to stop
+    the workers and free the shared memory. With an environment there are as
+    many partitions as towns, or processes if that is fewer. Without a seed,
+    the workers are seeded from the global generator
+    """
+
+    def __init__(self, ni=1000, nj=100, nk=10, env_file=None, dynam_price=False, dynam_actors=False,
+                    params=None, processes=None, seed=None):
+        super().__init__(ni, nj, nk, env_file, dynam_price, dynam_actors, params, bulk=True)
+
+        self.num_parts = processes or os.cpu_count()
+        if self.environment is not None:
+            self.num_parts = min(self.num_parts, len(self.environment.towns))
+        if seed is None:
+            seed = int(np.random.randint(2**31))
+
+        positions = self.patients.positions
+        parts = partition_positions(positions, self.system_size, self.environment,
+                                        self.num_parts)
+        self.links = [] # New sellers whose trust the workers must inherit
+
+        self.memory = None
+        self.map_table(max(2*len(self.sellers), 16))
+
+        self.connections = []
+        self.workers = []
+        for tile in range(self.num_parts):
+            mine, theirs = Pipe()
+            worker = Process(target=_worker_main, daemon=True,
+                                args=(theirs, tile, positions[parts == tile],
+                                        self.system_size, self.params, seed))
+            worker.start()
+            theirs.close()
+            mine.send( ("map", self.memory.name, self.capacity) )
+            self.connections.append(mine)
+            self.workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def map_table(self, capacity):
+        """ Allocates a new shared seller table with room for capacity sellers """
+        old = self.memory
+        self.capacity = capacity
+        self.memory = SharedMemory(create=True, size=capacity*NUM_COLUMNS*8)
+        self.table = np.ndarray((capacity, NUM_COLUMNS), dtype=np.float64,
+                                    buffer=self.memory.buf)
+        if old is not None:
+            for connection in self.connections:
+                connection.send( ("map", self.memory.name, capacity) )
+            old.close()
+            old.unlink()
+
+    def write_table(self):
+        """ Copies the current seller state into shared memory """
+        n = len(self.sellers)
+        if n > self.capacity:
+            self.map_table(2*n)
+        positions = [seller.position for seller in self.sellers]
+        owners = partition_positions(positions, self.system_size, self.environment,
+                                        self.num_parts) if n else []
+        for row, (seller, owner) in enumerate(zip(self.sellers, owners)):
+            self.table[row] = (seller.position[0], seller.position[1], seller.price,
+                                seller.quality, seller.supply, seller.uid, owner)
+        return n
+
+    def link_patients(self, old, new):
+        # The patients live in the workers, so the link is passed on next step
+        self.links.append( (old, new) )
+
+    def patient_phase(self, n_samples=None):
+        """
+        Runs every partition's purchases concurrently, then reconciles them.
+        Each partition samples 20% of its own patients, so n_samples is ignored
+        """
+        n_sellers = self.write_table()
+        for connection in self.connections:
+            connection.send( ("step", n_sellers, self.links) )
+        self.links = []
+
+        replies = [connection.recv() for connection in self.connections]
+        for reply in replies:
+            if reply[0] == "error":
+                raise AttributeError(reply[1])
+
+        # Local sales first: owners never sell more than they hold
+        for kind, sales, requests, out_of_stock, choices in replies:
+            for row in np.nonzero(sales)[0]:
+                self.sellers[row].make_purchases(int(sales[row]))
+            for row in np.nonzero(choices)[0]:
+                uid = self.sellers[row].uid
+                self.watcher.choice_tally[uid] = (self.watcher.choice_tally.get(uid, 0)
+                                                    + int(choices[row]))
+            self.watcher.out_of_stock += out_of_stock
+
+        # Then requests across partitions, in partition order
+        for connection, reply in zip(self.connections, replies):
+            granted = []
+            for row in reply[2]:
+                seller = self.sellers[row]
+                if seller.supply >= 1:
+                    seller.make_purchase()
+                    granted.append(True)
+                else:
+                    self.watcher.inform_oos()
+                    granted.append(False)
+            connection.send( ("grants", granted) )
+
+        for connection in self.connections:
+            connection.recv()
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send( ("stop",) )
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
+
+        if self.memory is not None:
+            self.table = None
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
@@ -0,0 +1,156 @@
+"""
+This file implements recording of simulation trajectories to disk, and reading
+them back for replay.
+
+A recording is a directory of append-only binary files:
+    sellers.bin     float64 rows of (x, y, quality, price, uid), all frames
+    suppliers.bin   float64 rows of (x, y, quality, price, uid), all frames
+    frames.bin      int64 rows of (step, seller offset, seller count,
+                        supplier offset, supplier count), one per frame
+    meta.json       towns and system size
+Since each frame stores its own offsets and counts, the number of actors can
+change from frame to frame (as it does with dynamic actors). The reader maps
+the files into memory, so frames are only read from disk when they are used.
+"""
+import json
+import os
+
+import numpy as np
+
+from actors import Town
+
+ACTOR_FIELDS = 5    # x, y, quality, price, uid
+FRAME_FIELDS = 5    # step, seller offset, seller count, supplier offset, supplier count
+
+
+def actor_rows(actors):
+    """ Packs the recorded properties of a list of actors into an array """
+    rows = np.empty((len(actors), ACTOR_FIELDS), dtype=np.float64)
+    for n, actor in enumerate(actors):
+        rows[n] = (actor.position[0], actor.position[1], actor.quality,
+                    actor.price, actor.uid)
+    return rows
+
+
+class TrajectoryRecorder():
+    """
+    This class appends frames of seller and supplier state to a recording
+    directory
+    """
+
+    def __init__(self, directory, sim):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        towns = []
+        if sim.environment:
+            towns = [[t.name, t.size, t.x, t.y, t.sigmax, t.sigmay]
+                        for t in sim.environment.towns]
+        meta = {'towns': towns, 'environment': sim.environment is not None,
+                'system_size': sim.system_size}
+        with open(os.path.join(directory, "meta.json"), 'w') as f:
+            json.dump(meta, f)
+
+        self.sellers    = open(os.path.join(directory, "sellers.bin"), 'wb')
+        self.suppliers  = open(os.path.join(directory, "suppliers.bin"), 'wb')
+        self.frames     = open(os.path.join(directory, "frames.bin"), 'wb')
+        self.seller_offset      = 0
+        self.supplier_offset    = 0
+        self.num_frames         = 0
+
+    def record(self, step, sim):
+        """ Appends the current state of the simulation as a frame """
+        sellers = actor_rows(sim.sellers)
+        suppliers = actor_rows(sim.suppliers)
+
+        sellers.tofile(self.sellers)
+        suppliers.tofile(self.suppliers)
+        # The rows must be on disk before the index row that points to them,
+        # so that a reader refreshing during the run never sees a partial frame
+        self.sellers.flush()
+        self.suppliers.flush()
+        np.array([step, self.seller_offset, len(sellers),
+                    self.supplier_offset, len(suppliers)], dtype=np.int64
+                    ).tofile(self.frames)
+        self.frames.flush()
+
+        self.seller_offset += len(sellers)
+        self.supplier_offset += len(suppliers)
+        self.num_frames += 1
+
+    def flush(self):
+        for f in (self.sellers, self.suppliers, self.frames):
+            f.flush()
+
+    def close(self):
+        for f in (self.sellers, self.suppliers, self.frames):
+            f.close()
+
+
+class TrajectoryReader():
+    """
+    This class gives lazy, random access to the frames of a recording. Only
+    the pages of the files that hold a requested frame are read from disk
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), 'r') as f:
+            meta = json.load(f)
+
+        self.towns          = [Town(*t) for t in meta['towns']]
+        self.environment    = meta['environment']
+        self.system_size    = meta['system_size']
+        self.refresh()
+
+    def _map(self, name, dtype, fields):
+        path = os.path.join(self.directory, name)
+        rows = os.path.getsize(path) // (np.dtype(dtype).itemsize * fields)
+        if rows == 0:
+            return np.zeros((0, fields), dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(rows, fields))
+
+    def refresh(self):
+        """
+        Re-maps the files, picking up frames appended since opening. The index
+        is mapped first, since every frame in it has its rows written already
+        """
+        self.frames     = self._map("frames.bin", np.int64, FRAME_FIELDS)
+        self.sellers    = self._map("sellers.bin", np.float64, ACTOR_FIELDS)
+        self.suppliers  = self._map("suppliers.bin", np.float64, ACTOR_FIELDS)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def step(self, frame):
+        return int(self.frames[frame, 0])
+
+    def frame(self, frame):
+        """ Returns (step, seller rows, supplier rows) for a frame """
+        step, sell_off, sell_n, sup_off, sup_n = self.frames[frame]
+        return (int(step), self.sellers[sell_off:sell_off + sell_n],
+                self.suppliers[sup_off:sup_off + sup_n])
+
+    def plot_data(self, frame, initial=False):
+        """
+        Returns a frame in the tuple format the Animator takes from its plot
+        queue. The initial frame of a map also carries the towns
+        """
+        step, sellers, suppliers = self.frame(frame)
+        x, y, q = list(sellers[:, 0]), list(sellers[:, 1]), list(sellers[:, 2])
+        supx, supy, supq = (list(suppliers[:, 0]), list(suppliers[:, 1]),
+                            list(suppliers[:, 2]))
+
+        if not self.environment:
+            return (x, q, supx, supq)
+        if initial:
+            return (x, y, q, supx, supy, supq, self.towns)
+        return (x, y, q, supx, supy, supq)
+
+    def describe(self, frame, actor, ind):
+        """ A short description of a recorded actor, for the pick handler """
+        step, sellers, suppliers = self.frame(frame)
+        rows = suppliers if actor == "Supplier" else sellers
+        x, y, quality, price, uid = rows[ind]
+        return "{0} {1:04d} | Quality: {2:04f} | Price: {3:04f} | Position ({4:6.02f},{5:6.02f})".format(
+                    actor, int(uid), quality, price, x, y)
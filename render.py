@@ -0,0 +1,115 @@
+"""
+This file renders a recorded run (see recorder.py) to a sequence of PNG images
+without a display, using matplotlib's Agg backend.
+
+Frames are split across a pool of worker processes. Each worker sets up its
+figure once, including the static town ellipses, and then only moves the
+seller and supplier markers for every frame it draws.
+"""
+from multiprocessing import Pool
+from optparse import OptionParser
+import os
+import sys
+
+from recorder import TrajectoryReader
+
+# Per-worker state, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(directory, out_dir, dpi, size):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Ellipse
+
+    reader = TrajectoryReader(directory)
+    fig, ax = plt.subplots(figsize=size)
+
+    if reader.environment:
+        if reader.towns:
+            max_x = max( [ t.x + 5*t.sigmax for t in reader.towns] )
+            max_y = max( [ t.y + 5*t.sigmay for t in reader.towns] )
+        else:
+            max_x, max_y = reader.system_size
+        for town in reader.towns:
+            for scale in (2, 4, 6):
+                ax.add_artist( Ellipse( (town.x,town.y), scale*town.sigmax,
+                                        scale*town.sigmay, fill=False, color='r' ) )
+        sellers = ax.scatter([], [], c=[], s=200, cmap='YlGn', vmin=0, vmax=1, label="Sellers")
+        suppliers = ax.scatter([], [], c=[], s=400, cmap='YlGn', vmin=0, vmax=1,
+                                marker='X', label="Suppliers")
+    else:
+        max_x, max_y = reader.system_size, 1.1
+        sellers = ax.scatter([], [], color="blue", s=50, label="Sellers")
+        suppliers = ax.scatter([], [], color='red', s=200, label="Suppliers")
+
+    ax.set_xlim(0, max_x)
+    ax.set_ylim(0, max_y)
+
+    _worker.update(reader=reader, fig=fig, ax=ax, sellers=sellers,
+                    suppliers=suppliers, out_dir=out_dir, dpi=dpi)
+
+
+def _render_frames(frames):
+    """ Renders a chunk of frames in a worker, returning the number drawn """
+    reader  = _worker['reader']
+    ax      = _worker['ax']
+    for frame in frames:
+        step, sellers, suppliers = reader.frame(frame)
+        if reader.environment:
+            _worker['sellers'].set_offsets(sellers[:, 0:2])
+            _worker['sellers'].set_array(sellers[:, 2])
+            _worker['suppliers'].set_offsets(suppliers[:, 0:2])
+            _worker['suppliers'].set_array(suppliers[:, 2])
+        else: # 1D: quality is plotted against position
+            _worker['sellers'].set_offsets(sellers[:, [0, 2]])
+            _worker['suppliers'].set_offsets(suppliers[:, [0, 2]])
+
+        ax.set_title("Step {}".format(step))
+        path = os.path.join(_worker['out_dir'], "frame_{:06d}.png".format(frame))
+        _worker['fig'].savefig(path, dpi=_worker['dpi'])
+
+    return len(frames)
+
+
+def render(directory, out_dir, processes=None, frames=None, chunk=50, dpi=100,
+            size=(12, 8)):
+    """
+    Renders the frames of the recording in directory (all of them by default)
+    to out_dir/frame_NNNNNN.png using a pool of processes
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if frames is None:
+        frames = range(len(TrajectoryReader(directory)))
+    frames = list(frames)
+    chunks = [frames[n:n+chunk] for n in range(0, len(frames), chunk)]
+
+    done = 0
+    with Pool(processes, _init_worker, (directory, out_dir, dpi, size)) as pool:
+        for count in pool.imap_unordered(_render_frames, chunks):
+            done += count
+            sys.stdout.write("\rRendered {}/{} frames".format(done, len(frames)))
+            sys.stdout.flush()
+    sys.stdout.write("\n")
+
+
+def main():
+    parser = OptionParser("Usage: >> python render.py [options] <recording_dir> <output_dir>")
+    parser.add_option("--procs", action="store", default=None, type="int",
+        help="Use this option to specify the number of worker processes (default: all cores)")
+    parser.add_option("--every", action="store", default=1, type="int",
+        help="Use this option to render only every n'th frame (default: 1)")
+    parser.add_option("--dpi", action="store", default=100, type="int",
+        help="Use this option to specify the image resolution (default: 100)")
+
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("A recording directory and an output directory are required")
+
+    frames = range(0, len(TrajectoryReader(args[0])), options.every)
+    render(args[0], args[1], options.procs, frames, dpi=options.dpi)
+
+
+if __name__ == "__main__":
+    main()
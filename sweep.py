@@ -0,0 +1,239 @@
+"""
+This file runs sweeps over the behavioural parameters of the model.
+
+Each parameter set is simulated for a number of replicates, with the work spread
+across a pool of worker processes. Every simulation gets its own Parameters
+object, so different parameter sets never interfere with one another. The mean
+quality trajectories are collected into a single tidy array with one row per
+(parameter set, replicate, sample).
+"""
+import itertools
+from multiprocessing import Pool
+from optparse import OptionParser
+import sys
+
+import numpy as np
+
+from actors import OutcomeStream, Parameters
+from trust import Simulation, run_replicate, seed_rngs
+from variance import paired_difference
+
+# These parameters are counts, so they are rounded when sampled
+INTEGER_PARAMETERS = ('top_n', 'bust_number', 'min_top_n')
+
+
+def check_name(name):
+    """ Only numeric parameters can be swept, since results are tabulated as floats """
+    if name not in Parameters.names:
+        raise AttributeError("Unknown parameter: {}".format(name))
+    if name not in Parameters.numeric:
+        raise AttributeError("Parameter {} is not numeric, so it cannot be swept".format(name))
+
+
+def grid(**values):
+    """
+    Returns every combination of the given parameter values as a list of
+    dictionaries, e.g. grid(top_n=[5, 20], epsilon=[0.1, 0.2])
+    """
+    for name in values:
+        check_name(name)
+
+    names = sorted(values)
+    return [dict(zip(names, combination)) for combination in
+                itertools.product(*[values[name] for name in names])]
+
+
+def latin_hypercube(ranges, n, seed=None):
+    """
+    Returns n parameter sets drawn from a Latin hypercube over the given
+    ranges, which map parameter names to (low, high) tuples
+    """
+    for name in ranges:
+        check_name(name)
+
+    rng = np.random.default_rng(seed)
+    names = sorted(ranges)
+    param_sets = [{} for _ in range(n)]
+    for name in names:
+        low, high = ranges[name]
+        # One sample from each of n equal strata, in a random order
+        strata = (rng.permutation(n) + rng.random(n)) / n
+        values = low + strata*(high - low)
+        for param_set, value in zip(param_sets, values):
+            if name in INTEGER_PARAMETERS:
+                param_set[name] = int(round(value))
+            else:
+                param_set[name] = float(value)
+
+    return param_sets
+
+
+class SweepResult():
+    """
+    This class holds the mean quality trajectories of a sweep, indexed by
+    (parameter set, replicate, sample). With crn, replicate r of every
+    parameter set was run on the same random numbers
+    """
+
+    def __init__(self, param_sets, qualities, sample_every, crn=False):
+        self.param_sets     = param_sets
+        self.qualities      = qualities
+        self.sample_every   = sample_every
+        self.crn            = crn
+
+    def mean(self):
+        """ Average trajectory of each parameter set over its replicates """
+        return self.qualities.mean(axis=1)
+
+    def compare(self, a, b):
+        """
+        The difference in mean quality of parameter set b over set a at each
+        sample, with its confidence half-width. With common random numbers the
+        interval comes from the paired replicates
+        """
+        result = paired_difference(self.qualities[a], self.qualities[b])
+        if not self.crn: # Independent runs, so there are no pairs to use
+            result['half_width'] = result['unpaired_half_width']
+            result['reduction'] = np.ones_like(result['difference'])
+        return result
+
+    def tidy(self):
+        """
+        Returns a structured array with one row per (parameter set, replicate,
+        sample), holding the parameter values alongside the mean quality
+        """
+        n_sets, n_reps, n_samples = self.qualities.shape
+        names = sorted(set(itertools.chain.from_iterable(self.param_sets)))
+        dtype = ([('set', np.int32)] + [(name, np.float64) for name in names]
+                    + [('replicate', np.int32), ('step', np.int64),
+                        ('mean_quality', np.float64)])
+
+        table = np.zeros(n_sets*n_reps*n_samples, dtype=dtype)
+        sets, reps, samples = np.meshgrid(np.arange(n_sets), np.arange(n_reps),
+                                            np.arange(n_samples), indexing='ij')
+        table['set']            = sets.ravel()
+        table['replicate']      = reps.ravel()
+        table['step']           = samples.ravel()*self.sample_every
+        table['mean_quality']   = self.qualities.ravel()
+
+        defaults = Parameters().as_dict()
+        for name in names:
+            values = [p.get(name, defaults[name]) for p in self.param_sets]
+            table[name] = np.asarray(values, dtype=np.float64)[table['set']]
+
+        return table
+
+
+def _run_job(job):
+    """ Runs one replicate of one parameter set inside a worker process """
+    (index, rep, values, seed, ni, nj, nk, num_trials, dynam_price,
+        dynam_actors, env_file, sample_every, crn) = job
+
+    seed_rngs(seed)
+    # With common random numbers, treatment outcomes come from their own
+    # stream, so they stay matched even when the runs make different choices
+    params = Parameters(outcomes=OutcomeStream(seed) if crn else None).replace(**values)
+    sim = Simulation(ni, nj, nk, env_file, dynam_price, dynam_actors, params)
+    qualities = run_replicate(sim, num_trials, sample_every)
+
+    return index, rep, np.asarray(qualities, dtype=np.float64)
+
+
+def run_sweep(param_sets, ni=1000, nj=100, nk=10, num_trials=1000,
+                dynam_price=False, dynam_actors=False, replicates=1,
+                env_file=None, processes=None, seed=0, sample_every=2, crn=False):
+    """
+    Runs every parameter set for the given number of replicates across a pool
+    of processes (all cores by default) and returns a SweepResult. With crn,
+    every parameter set uses the same seed for a given replicate
+    """
+    n_samples = len(range(0, num_trials, sample_every))
+    # Independent seeds for every (parameter set, replicate) pair, or for
+    # every replicate when they are shared
+    children = np.random.SeedSequence(seed).spawn(replicates if crn
+                                                    else len(param_sets)*replicates)
+    seeds = [int(child.generate_state(1)[0]) for child in children]
+
+    jobs = []
+    for index, values in enumerate(param_sets):
+        for rep in range(replicates):
+            job_seed = seeds[rep] if crn else seeds[index*replicates + rep]
+            jobs.append( (index, rep, values, job_seed,
+                            ni, nj, nk, num_trials, dynam_price, dynam_actors,
+                            env_file, sample_every, crn) )
+
+    qualities = np.zeros((len(param_sets), replicates, n_samples))
+    done = 0
+    with Pool(processes) as pool:
+        for index, rep, quals in pool.imap_unordered(_run_job, jobs):
+            qualities[index, rep] = quals
+            done += 1
+            sys.stdout.write("\rCompleted {}/{} simulations".format(done, len(jobs)))
+            sys.stdout.flush()
+    sys.stdout.write("\n")
+
+    return SweepResult(param_sets, qualities, sample_every, crn)
+
+
+def parse_values(text):
+    """ Parses 'name=v1,v2,v3' into a name and a list of values """
+    name, values = text.split("=")
+    cast = int if name in INTEGER_PARAMETERS else float
+    return name, [cast(v) for v in values.split(",")]
+
+
+def main():
+    parser = OptionParser("Usage: >> python sweep.py [options] [config_file]")
+    parser.add_option("-n", action="store", dest="n_runs", default=1000, type="int",
+        help="Use this to specify the number of timesteps per run (default: 1000)")
+    parser.add_option("--dp", action="store_true", default=False,
+        help="Use this option to enable dynamic pricing for vendors")
+    parser.add_option("--da", action="store_true", default=False,
+        help="Use this option to enable dynamic numbers of vendors")
+    parser.add_option("--ni", action="store", default=1000, type="int",
+        help="Use this option to specify the number of patients (default: 1000)")
+    parser.add_option("--nj", action="store", default=100, type="int",
+        help="Use this option to specify the number of sellers (default: 100)")
+    parser.add_option("--nk", action="store", default=10, type="int",
+        help="Use this option to specify the number of suppliers (default: 10)")
+    parser.add_option("--grid", action="append", default=[],
+        help="Grid values for a parameter, e.g. --grid top_n=5,10,20 (repeatable)")
+    parser.add_option("--range", action="append", default=[],
+        help="Latin hypercube range for a parameter, e.g. --range epsilon=0.05,0.2")
+    parser.add_option("--lhs", action="store", default=0, type="int",
+        help="Use this option to draw this many Latin hypercube samples of the ranges")
+    parser.add_option("--reps", action="store", default=10, type="int",
+        help="Use this option to specify the replicates per parameter set (default: 10)")
+    parser.add_option("--procs", action="store", default=None, type="int",
+        help="Use this option to specify the number of worker processes (default: all cores)")
+    parser.add_option("--seed", action="store", default=0, type="int",
+        help="Use this option to specify the base random seed (default: 0)")
+    parser.add_option("--crn", action="store_true", default=False,
+        help="Use this option to run every parameter set on common random numbers")
+    parser.add_option("-o", action="store", dest="output", default="sweep.npy",
+        help="Use this option to specify the output file (default: sweep.npy)")
+
+    (options, args) = parser.parse_args()
+    env_file = args[0] if args else None
+
+    if options.lhs > 0:
+        ranges = dict(parse_values(text) for text in options.range)
+        param_sets = latin_hypercube(ranges, options.lhs, options.seed)
+    else:
+        param_sets = grid(**dict(parse_values(text) for text in options.grid))
+
+    result = run_sweep(param_sets, options.ni, options.nj, options.nk,
+                        options.n_runs, options.dp, options.da, options.reps,
+                        env_file, options.procs, options.seed, crn=options.crn)
+    np.save(options.output, result.tidy())
+
+    for index in range(1, len(param_sets)): # Each set against the first
+        comparison = result.compare(0, index)
+        print("Set {} - set 0: mean difference {:+.4f} +- {:.4f} (+- {:.4f} unpaired)".format(
+                index, comparison['difference'].mean(), comparison['half_width'].mean(),
+                comparison['unpaired_half_width'].mean()))
+    print("Saved {} parameter sets to {}".format(len(param_sets), options.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+EnsembleAggregator's streaming statistics must match those of the runs kept in
+full. MetricHistory must hold exactly as many values as stored() says, each the
+mean of its samples, and a run held at its final value must match one that ran
+on.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aggregate import EnsembleAggregator, MetricHistory
+
+
+def filled(capacity, samples):
+    history = MetricHistory(capacity)
+    for value in samples:
+        history.append(value)
+    return history
+
+
+@pytest.mark.parametrize("count", [0, 1, 7, 8, 9, 15, 16, 17, 33, 100, 1001])
+def test_stored_matches_appends(count):
+    history = filled(8, np.arange(count, dtype=float))
+    assert len(history) == MetricHistory(8).stored(count)
+
+
+def test_compaction_keeps_means():
+    samples = np.arange(32, dtype=float)
+    history = filled(8, samples)
+    # Compacted twice: every value is the mean of 4 samples
+    assert history.stride == 4
+    assert np.allclose(history.values(), samples.reshape(-1, 4).mean(axis=1))
+    assert list(history.steps(2)) == list(range(0, 64, 8))
+
+
+@pytest.mark.parametrize("stop", [1, 5, 8, 13, 30])
+def test_hold_matches_running_on(stop):
+    samples = np.random.default_rng(stop).random(stop)
+    held = filled(8, samples)
+    held.hold(50)
+    full = filled(8, np.concatenate( (samples, np.full(50 - stop, samples[-1])) ))
+    assert held.count == 50
+    assert len(held) == MetricHistory(8).stored(50)
+    assert np.allclose(held.values(), full.values())
+
+
+def test_welford_matches_numpy():
+    runs = np.random.default_rng(1).random((25, 12))
+    ensemble = EnsembleAggregator()
+    for run in runs:
+        ensemble.add(run)
+    assert np.allclose(ensemble.mean, runs.mean(axis=0))
+    assert np.allclose(ensemble.variance(), runs.var(axis=0, ddof=1))
+    assert np.allclose(ensemble.stderr(), runs.std(axis=0, ddof=1) / 5)
+
+
+def test_shorter_runs_are_held():
+    ensemble = EnsembleAggregator()
+    ensemble.add([0.2, 0.4, 0.6])
+    ensemble.add([0.2, 0.8], hold_to=3)
+    assert list(ensemble.count) == [2, 2, 2]
+    assert np.allclose(ensemble.mean, [0.2, 0.6, 0.7])
+
+
+def test_quantiles_within_a_bin():
+    runs = np.random.default_rng(2).random((2000, 3))
+    ensemble = EnsembleAggregator(bins=100)
+    for run in runs:
+        ensemble.add(run)
+    for q in (0.1, 0.5, 0.9):
+        assert np.allclose(ensemble.quantile(q), np.quantile(runs, q, axis=0), atol=0.01)
+
+
+def test_reservoir_is_bounded_and_uniform():
+    kept = np.zeros(100)
+    for seed in range(200):
+        ensemble = EnsembleAggregator(reservoir_size=10, seed=seed)
+        for i in range(100):
+            ensemble.add([i / 100])
+        assert len(ensemble.reservoir) == 10
+        for run in ensemble.reservoir:
+            kept[int(round(run[0]*100))] += 1
+    # Each run is kept with probability 1/10, so 20 times in 200 ensembles
+    assert kept.sum() == 2000
+    assert kept[:50].sum() == pytest.approx(kept[50:].sum(), rel=0.15)
@@ -0,0 +1,40 @@
+"""
+A cached replicate must only be read back for the same run of the same code,
+and an entry that cannot be read must be recomputed rather than crash a series.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cache
+from cache import ResultCache
+
+SPEC = {'ni': 10, 'nj': 2, 'nk': 1, 'num_trials': 6}
+
+
+def test_round_trip(tmp_path):
+    results = ResultCache(str(tmp_path))
+    results.put(SPEC, 0, [0.1, 0.2, 0.3], stop_step=-1)
+    qualities, stats = results.get(SPEC, 0)
+    assert list(qualities) == [0.1, 0.2, 0.3]
+    assert stats['final'] == 0.3 and stats['stop_step'] == -1
+    assert results.get(SPEC, 1) is None
+
+
+def test_truncated_entry_is_a_miss(tmp_path):
+    results = ResultCache(str(tmp_path))
+    results.put(SPEC, 0, [0.1, 0.2, 0.3])
+    path = results.path(results.key(SPEC, 0))
+    with open(path, 'rb') as f:
+        data = f.read()
+    for size in (0, 10, len(data)//2, len(data) - 1):
+        with open(path, 'wb') as f:
+            f.write(data[:size])
+        assert results.get(SPEC, 0) is None
+
+
+def test_code_version_covers_the_simulation_path():
+    for name in ('actors.py', 'aggregate.py', 'cohort.py', 'convergence.py', 'trust.py'):
+        assert name in cache.CODE_FILES
@@ -0,0 +1,82 @@
+"""
+The equivalence harness must catch a candidate that changes the model, and
+the faster implementations must pass it at a configuration where it has the
+power to see a difference.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import equivalence
+from actors import Patient
+
+# Small enough to run in seconds, long and replicated enough that a change in
+# the treatment outcome shows up in the stock-outs
+CONFIG = {'ni': 200, 'nj': 20, 'nk': 5, 'num_trials': 200, 'env_file': None,
+            'dynam_price': False, 'dynam_actors': False}
+SEEDS = list(range(30))
+
+
+@pytest.fixture(scope="module")
+def reference_runs():
+    return equivalence.RUNNERS['reference'](CONFIG, SEEDS)
+
+
+def quality_outcomes(config, seeds):
+    """ The reference model, except that patients are judged on quality """
+    def buy_from(self, seller):
+        seller.make_purchase()
+        return self.take(seller.quality), ""
+
+    original = Patient.buy_from
+    Patient.buy_from = buy_from
+    try:
+        return equivalence.RUNNERS['reference'](config, seeds)
+    finally:
+        Patient.buy_from = original
+
+
+def test_holm():
+    adjusted = equivalence.holm([0.01, 0.04, 0.03, 0.005])
+    assert np.allclose(adjusted, [0.03, 0.06, 0.06, 0.02])
+
+
+def test_reference_passes_against_itself(reference_runs):
+    other = equivalence.RUNNERS['reference'](CONFIG, [100 + seed for seed in SEEDS])
+    results = equivalence.compare(reference_runs, other)
+    assert all(r['passed'] for r in results.values())
+
+
+def test_perturbed_candidate_is_rejected(reference_runs):
+    results = equivalence.compare(reference_runs, quality_outcomes(CONFIG, SEEDS))
+    assert not results['out_of_stock']['passed']
+
+
+def assert_equivalent(reference_runs, candidate):
+    results = equivalence.compare(reference_runs, equivalence.RUNNERS[candidate](CONFIG, SEEDS))
+    failed = {name: r for name, r in results.items() if not r['passed']}
+    assert not failed, failed
+
+
+def test_batched_matches_reference(reference_runs):
+    assert_equivalent(reference_runs, 'batched')
+
+
+def test_cohort_matches_reference(reference_runs):
+    assert_equivalent(reference_runs, 'cohort')
+
+
+# The parallel model partitions by town, so it is checked on a map
+TOWNS = dict(CONFIG, ni=400, env_file=os.path.join(ROOT, "trust.config"), processes=2)
+
+
+def test_parallel_matches_reference():
+    reference = equivalence.RUNNERS['reference'](TOWNS, SEEDS)
+    results = equivalence.compare(reference, equivalence.RUNNERS['parallel'](TOWNS, SEEDS))
+    failed = {name: r for name, r in results.items() if not r['passed']}
+    assert not failed, failed
@@ -0,0 +1,40 @@
+"""
+Importing trust must stay cheap and free of side effects, since every sweep
+and worker process does it: no plotting or multiprocessing modules, no
+logging configuration, and a bounded import time.
+"""
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cumulative microseconds allowed for "import trust". Numpy accounts for most
+# of the ~150ms this takes; the budget leaves room for slower machines
+BUDGET = 500000
+
+CHECK = """
+import logging, sys
+import trust
+print(",".join(name for name in ("matplotlib", "multiprocessing") if name in sys.modules))
+print(len(logging.getLogger().handlers))
+"""
+
+
+def run_import():
+    return subprocess.run([sys.executable, "-X", "importtime", "-c", CHECK], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+
+
+def test_import_is_side_effect_free():
+    loaded, handlers = run_import().stdout.split("\n")[:2]
+    assert loaded == ""
+    assert handlers == "0"
+
+
+def test_import_time_budget():
+    stderr = run_import().stderr
+    match = re.search(r"^import time:\s+\d+ \|\s+(\d+) \| trust$", stderr, re.MULTILINE)
+    assert match is not None
+    assert int(match.group(1)) < BUDGET
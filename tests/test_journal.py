@@ -0,0 +1,78 @@
+"""
+A churn journal must give back the population of the run it recorded, and the
+lineage of every vendor back to an initial one, however its records are split
+across shards.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from journal import BUST, INITIAL, SPAWN, ChurnJournal, JournalReader
+from trust import Simulation, seed_rngs
+
+
+@pytest.fixture(scope="module")
+def journalled(tmp_path_factory):
+    """ A run with dynamic actors, journalled in small shards """
+    directory = str(tmp_path_factory.mktemp("journal"))
+    seed_rngs(3)
+    sim = Simulation(60, 6, 2, dynam_actors=True)
+    sim.journal = ChurnJournal(directory, sim, shard_size=4, flush_every=3)
+    alive = {} # Sellers and suppliers after each step
+    for step in range(300):
+        sim.time_step_sto()
+        sim.watcher.reset()
+        alive[step] = (len(sim.sellers), len(sim.suppliers))
+    sim.journal.close()
+    return sim, alive, JournalReader(directory)
+
+
+def test_population_matches_run(journalled):
+    sim, alive, reader = journalled
+    assert len(reader.shards) > 2
+    for n, actor in enumerate(("seller", "supplier")):
+        steps, counts = reader.population(actor)
+        assert len(steps) > 1
+        for step, count in zip(steps, counts):
+            assert count == alive[step][n]
+        assert counts[-1] == len(sim.sellers if n == 0 else sim.suppliers)
+
+
+def test_population_between_steps(journalled):
+    sim, alive, reader = journalled
+    steps, counts = reader.population("seller")
+    start, stop = steps[1], steps[-2]
+    part = reader.population("seller", start, stop)
+    keep = (steps >= start) & (steps <= stop)
+    assert np.array_equal(part[0], steps[keep])
+    assert np.array_equal(part[1], counts[keep])
+
+
+def test_lineage_of_every_seller(journalled):
+    sim, alive, reader = journalled
+    depths = []
+    for seller in sim.sellers:
+        line = reader.lineage(seller.uid)
+        assert line[0]['kind'] == INITIAL and line[0]['parent'] == -1
+        assert all(record['kind'] == SPAWN for record in line[1:])
+        assert [int(record['parent']) for record in line[1:]] == \
+                [int(record['uid']) for record in line[:-1]]
+        assert int(line[-1]['uid']) == seller.uid
+        depths.append(len(line))
+    assert max(depths) > 1
+    with pytest.raises(KeyError):
+        reader.lineage(10**6)
+
+
+def test_busts_are_journalled(journalled):
+    sim, alive, reader = journalled
+    records = reader.events()
+    busts = records[records['kind'] == BUST]
+    assert len(busts) > 0
+    assert not set(int(uid) for uid in busts['uid'][busts['actor'] == 0]) & \
+                set(seller.uid for seller in sim.sellers)
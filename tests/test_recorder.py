@@ -0,0 +1,57 @@
+"""
+A recording must read back every frame as it was recorded, in any order, and a
+reader opened during a run must pick up the frames written since.
+"""
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from recorder import TrajectoryReader, TrajectoryRecorder, actor_rows
+from trust import Simulation, seed_rngs
+
+
+def record(directory, steps, every=5):
+    """ Records a small run with dynamic actors, returning the frames as recorded """
+    seed_rngs(3)
+    sim = Simulation(60, 6, 2, dynam_actors=True)
+    recorder = TrajectoryRecorder(directory, sim)
+    expected = []
+    for i in range(steps):
+        sim.time_step_sto()
+        if i % every == 0:
+            recorder.record(i, sim)
+            expected.append( (i, actor_rows(sim.sellers), actor_rows(sim.suppliers)) )
+        sim.watcher.reset()
+    return sim, recorder, expected
+
+
+def test_round_trip_and_seek(tmp_path):
+    sim, recorder, expected = record(str(tmp_path), 60)
+    recorder.close()
+
+    reader = TrajectoryReader(str(tmp_path))
+    assert len(reader) == len(expected)
+    assert reader.system_size == sim.system_size
+    # Out of order, as a scrubbing replay would ask for them
+    for n in np.random.default_rng(0).permutation(len(expected)):
+        step, sellers, suppliers = reader.frame(n)
+        assert step == reader.step(n) == expected[n][0]
+        assert np.array_equal(sellers, expected[n][1])
+        assert np.array_equal(suppliers, expected[n][2])
+
+
+def test_refresh_picks_up_new_frames(tmp_path):
+    sim, recorder, expected = record(str(tmp_path), 20)
+    reader = TrajectoryReader(str(tmp_path))
+    assert len(reader) == len(expected)
+
+    recorder.record(20, sim)
+    reader.refresh()
+    assert len(reader) == len(expected) + 1
+    assert reader.step(len(expected)) == 20
+    assert np.array_equal(reader.frame(len(expected))[1], actor_rows(sim.sellers))
+    recorder.close()
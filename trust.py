@@ -7,22 +7,30 @@ quality and the placebo effect) and update their trust in that seller
 accordingly. The Sellers themselves purchase their medicine from Suppliers, and
 also develop trust in the same way.
 """
+import random
 from random import random as rand, shuffle, uniform
 import numpy as np
-import matplotlib.pyplot as plt
-from multiprocessing import Process, Queue, Pipe
-from logging import basicConfig, debug, DEBUG
+from logging import basicConfig, debug, DEBUG, WARNING
 import time
+import threading
 import copy
 import sys
 from optparse import OptionParser
 
 from actors import *
-from animator import Animator
+from aggregate import EnsembleAggregator, MetricHistory, hold
+from variance import Z95, antithetic_mean, replicates_needed
+from recorder import TrajectoryRecorder, TrajectoryReader
+from journal import ChurnJournal
+from convergence import ConvergenceDetector
+from cohort import CohortPatients
+from memory import MemoryMonitor, frame_size
+from cache import ResultCache, run_spec, DEFAULT_DIR
 
-basicConfig(level=DEBUG,
-            format='(%(threadName)-10s) %(message)s',
-            )
+PHASES = ('patients', 'sellers', 'suppliers') # The parts of time_step_sto
+
+# Plotting, animation and multiprocessing are only imported when they are first
+# used, so that headless and worker processes start quickly
 
 
 class Simulation():
@@ -30,41 +38,159 @@ class Simulation():
     This is the class to hold the simulation parameters
     """
 
-    def __init__(self, ni=1000, nj=100, nk=10, env_file=None, dynam_price=False, dynam_actors=False):
+    def __init__(self, ni=1000, nj=100, nk=10, env_file=None, dynam_price=False, dynam_actors=False, params=None,
+                    bulk=False, cohorts=False, cell_size=None, history=None, arrays=None):
 
         self.ni = ni    # Initial number of patients
         self.nj = nj    # Initial number of sellers
         self.nk = nk    # Initial number of wholesalers
         self.dynamic_price = dynam_price # Whether or not sellers/suppliers can change their price
         self.dynamic_actors = dynam_actors # Whether we can create and destroy actors
-        self.watcher = Watcher() # For keeping track of mean quality and such
+        self.stop_step = None # Set if the run is ended early on convergence
+        self.steps = 0 # Time steps taken so far
+        self.phase_times = dict.fromkeys(PHASES, 0.) # Seconds spent in each phase last step
+        self.history = history # If set, metric histories are compacted to this size
+        self.journal = None # If set, a ChurnJournal of actors created and gone bust
+        self.watcher = Watcher(history) # For keeping track of mean quality and such
+        # Behavioural parameters shared by every actor in this simulation
+        self.params = params if params is not None else Parameters()
 
         if env_file:
             self.environment = Environment(env_file)
             self.system_size = self.environment.system_size
         else:
+            self.environment = None
             self.system_size = ni # 1D
 
-        self.suppliers = [Supplier(k, self.system_size, self.watcher) for k in range(nk)]
+        if bulk or cohorts or arrays is not None: # Build the populations from arrays,
+                                                  # creating patients lazily
+            if arrays is None:
+                outcomes = self.params.outcomes # The antithetic twin also mirrors its initial state
+                arrays = self.random_arrays(outcomes is not None and outcomes.antithetic)
+            self.populate(**arrays)
+            if cohorts: # Group patients into weighted cohorts instead
+                self.patients = CohortPatients(self.patients.positions, self.system_size,
+                                                self.watcher, self.params, self.environment,
+                                                cell_size)
+            self.initial_purchase()
+            return
+
+        self.suppliers = [Supplier(k, self.system_size, self.watcher,
+                                    params=self.params) for k in range(nk)]
         self.last_supp = nk # Used to create unique ids for new suppleirs
 
         #ratio = np.floor(self.ni/self.nj)
-        self.sellers = [Seller(j, self.system_size, self.watcher, self.dynamic_price) for j in range(nj)]
+        self.sellers = [Seller(j, self.system_size, self.watcher,
+                            self.dynamic_price, params=self.params) for j in range(nj)]
         self.last_sell = nj
 
-        self.patients = [Patient(i, self.system_size, self.watcher, self.dynamic_price) for i in range(ni)]
+        self.patients = [Patient(i, self.system_size, self.watcher,
+                                    params=self.params) for i in range(ni)]
         self.last_pat = ni
 
         if env_file:
             self.set_positions(self.environment)
         else:
-            self.environment = None
             self.set_positions()
 
-        if self.sellers[0].cash > 0:    # We have chosen to give sellers some
-            for seller in self.sellers: # initial cash to buy medicine
+        self.initial_purchase()
+
+    @classmethod
+    def from_arrays(cls, arrays, env_file=None, dynam_price=False, dynam_actors=False, params=None):
+        """
+        Creates a simulation whose populations are given as arrays, with the
+        same keys as Simulation.populate takes
+        """
+        return cls(len(arrays['patient_positions']), len(arrays['seller_positions']),
+                    len(arrays['supplier_positions']), env_file, dynam_price, dynam_actors, params,
+                    arrays=arrays)
+
+    def initial_purchase(self):
+        if self.sellers and self.sellers[0].cash > 0: # We have chosen to give sellers some
+            for seller in self.sellers:               # initial cash to buy medicine
                 seller.choose_best(self.suppliers)
 
+    def random_arrays(self, mirror=False):
+        """
+        Draws the initial state of every actor in one pass, with the same
+        distributions as the actor constructors and set_positions use. With
+        mirror, every uniform draw u is replaced by 1-u (for antithetic runs)
+        """
+        ni, nj, nk = self.ni, self.nj, self.nk
+        uniform = np.random.random_sample
+        if mirror:
+            uniform = lambda n: 1 - np.random.random_sample(n)
+
+        if self.environment:
+            patient_pos = self.environment.get_positions(ni)
+            seller_pos = self.environment.get_positions(nj)
+            supplier_pos = self.environment.get_positions(nk)
+        else: # Spaced out along a line, as in set_positions
+            patient_pos = np.column_stack( (np.arange(ni) + uniform(ni), uniform(ni)) )
+            ratio = np.floor(ni/nj) if nj else 0
+            seller_pos = np.column_stack( (np.arange(nj)*ratio + uniform(nj), uniform(nj)) )
+            ratio = np.floor(ni/nk) if nk else 0
+            supplier_pos = np.column_stack( (np.arange(nk)*ratio + uniform(nk), uniform(nk)) )
+
+        return {
+            'patient_positions':    patient_pos,
+            'seller_positions':     seller_pos,
+            'seller_prices':        uniform(nj) + 1,
+            'seller_qualities':     uniform(nj),
+            'seller_cash':          30 + uniform(nj),
+            'seller_strategies':    uniform(nj),
+            'supplier_positions':   supplier_pos,
+            'supplier_prices':      1.0 + 0.25*uniform(nk),
+            'supplier_qualities':   uniform(nk),
+            'supplier_cash':        uniform(nk),
+        }
+
+    def populate(self, patient_positions, seller_positions, seller_prices, seller_qualities,
+                    seller_cash, supplier_positions, supplier_prices, supplier_qualities,
+                    supplier_cash, seller_strategies=None, system_size=None):
+        """
+        Replaces the populations with ones built from arrays. Patients are held
+        in a PatientPool and only become objects when used; distances are
+        worked out lazily by choose_best
+        """
+        if system_size is not None:
+            self.system_size = system_size
+        self.ni = len(patient_positions)
+        self.nj = len(seller_positions)
+        self.nk = len(supplier_positions)
+
+        # Suppliers keep fixed prices, as in the default construction
+        self.suppliers = [Supplier(k, self.system_size, self.watcher, False,
+                                    (float(pos[0]), float(pos[1])), params=self.params,
+                                    cash=float(cash), price=float(price), quality=float(qual))
+                            for k, (pos, price, qual, cash) in enumerate(zip(
+                                supplier_positions, supplier_prices, supplier_qualities,
+                                supplier_cash))]
+        self.last_supp = self.nk
+
+        if seller_strategies is None:
+            seller_strategies = np.random.random_sample(self.nj)
+        self.sellers = [Seller(j, self.system_size, self.watcher, self.dynamic_price,
+                                (float(pos[0]), float(pos[1])), params=self.params,
+                                cash=float(cash), price=float(price), quality=float(qual),
+                                strategy=float(strat))
+                            for j, (pos, price, qual, cash, strat) in enumerate(zip(
+                                seller_positions, seller_prices, seller_qualities,
+                                seller_cash, seller_strategies))]
+        self.last_sell = self.nj
+
+        self.patients = PatientPool(patient_positions, self.system_size, self.watcher,
+                                        self.params)
+        self.last_pat = self.ni
+
+    def link_patients(self, old, new):
+        """ Passes the patients' trust in an old seller on to a new one """
+        if isinstance(self.patients, list):
+            for patient in self.patients:
+                patient.make_vendor_link(old, new)
+        else:
+            self.patients.make_vendor_link(old, new)
+
 
     def __str__(self):
         suppliers   = "\n".join([str(s) for s in self.suppliers])
@@ -170,32 +296,56 @@ class Simulation():
             new_seller.make_dist_array(self.suppliers)
             self.sellers.append(new_seller)
             self.last_sell += 1 # Set the id for the next seller
-            debug(str(old_actor))
-            debug("Making new seller: " + str(new_seller))
-            for patient in self.patients:
-                patient.make_vendor_link(old_actor.uid, new_seller.uid)
+            debug("%s", old_actor)
+            debug("Making new seller: %s", new_seller)
+            if self.journal is not None:
+                self.journal.spawn(self.steps, new_seller, old_actor)
+            self.link_patients(old_actor.uid, new_seller.uid)
 
         else:
             new_supplier = old_actor.make_new(self.last_supp, position)
             self.suppliers.append(new_supplier)
             self.last_supp += 1
-            debug(str(old_actor))
-            debug("Making new supplier: " + str(new_supplier))
+            debug("%s", old_actor)
+            debug("Making new supplier: %s", new_supplier)
+            if self.journal is not None:
+                self.journal.spawn(self.steps, new_supplier, old_actor)
             for seller in self.sellers:
                 seller.make_vendor_link(old_actor.uid, new_supplier.uid)
 
     def time_step_sto(self, n_samples=None):
         """ Method to randomly choose n patients to purchase medicine """
+        start = time.perf_counter()
+        self.patient_phase(n_samples)
+        after_patients = time.perf_counter()
+        self.seller_phase()
+        after_sellers = time.perf_counter()
+        self.supplier_phase()
+        end = time.perf_counter()
+
+        self.phase_times = {'patients': after_patients - start,
+                            'sellers': after_sellers - after_patients,
+                            'suppliers': end - after_sellers}
+        self.steps += 1
+
+    def patient_phase(self, n_samples=None):
+        """ A random sample of patients each buy from their best seller """
         if not n_samples:
             n = int(len(self.patients) / 5) # Defaults to 20% of the patients
         else:
             n = n_samples
 
+        if isinstance(self.patients, CohortPatients):
+            self.patients.purchase(self.sellers, n)
+            return
+
         samples = list(range(len(self.patients)))
         shuffle(samples)
         for i in range(n):
             self.patients[samples[i]].choose_best(self.sellers)
 
+    def seller_phase(self):
+        """ Every seller restocks from their best supplier, in a random order """
         to_remove = []
         indices = list(range(len(self.sellers)))
         shuffle(indices)
@@ -212,11 +362,15 @@ class Simulation():
 
                 if function == "End": # This seller has gone bust
                     to_remove.append(i) # Remove it after iterating through the rest
-                    debug(str(seller) + " has gone bust")
+                    debug("%s has gone bust", seller)
+                    if self.journal is not None:
+                        self.journal.bust(self.steps, seller)
 
         for i in sorted(to_remove, reverse=True):
             del self.sellers[i]
 
+    def supplier_phase(self):
+        """ Every supplier turns their cash into new stock """
         to_remove = []
         for i in range(len(self.suppliers)):
             supplier = self.suppliers[i]
@@ -230,36 +384,72 @@ class Simulation():
 
                 if function == "End": # This seller has gone bust
                     to_remove.append(i) # Remove it after iterating through the rest
-                    debug(str(supplier) + " has gone bust")
+                    debug("%s has gone bust", supplier)
+                    if self.journal is not None:
+                        self.journal.bust(self.steps, supplier)
 
         for i in sorted(to_remove, reverse=True):
+            self.watcher.forget_supplier(self.suppliers[i].uid)
             del self.suppliers[i]
 
 
-def wait_for_input(sim, connection):
-    pause = True
-    debug("Animation Paused")
-    while pause:
-        while not connection.poll():
-            time.sleep(0.05)
-        request = connection.recv()
-
-        if request == "Pause":
-            pause = False
-        elif request == "Stop":
-            global stop
-            stop = True
-            break;
-        else:
-            actor, ind = request
-            if actor == "Supplier":
-                connection.send(sim.suppliers[ind])
-            else:
-                connection.send(sim.sellers[ind])
+class Controller():
+    """
+    This class serves the Animator's requests on a background thread, so that
+    they are answered as soon as they arrive. Pausing and stopping are passed
+    to the step loop through Events, which it waits on instead of polling, and
+    inspect requests are answered while the simulation keeps stepping
+    """
 
-def run_sim(num_trials, sim):
+    def __init__(self, sim, connection):
+        self.sim        = sim
+        self.connection = connection
+        self.running    = threading.Event() # Cleared while paused
+        self.stopped    = threading.Event()
+        self.running.set()
+        self.thread = threading.Thread(target=self.serve, name="control", daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while not self.stopped.is_set():
+            try:
+                request = self.connection.recv() # Blocks until the Animator sends
+            except (EOFError, OSError): # The Animator has gone
+                break
 
-    global stop
+            if request == "Pause":
+                if self.running.is_set():
+                    debug("Animation Paused")
+                    self.running.clear()
+                else:
+                    self.running.set()
+            elif request == "Stop":
+                self.stop()
+            else:
+                self.connection.send(self.describe(*request))
+        self.stop()
+
+    def describe(self, actor, ind):
+        """ A description of the ind'th seller or supplier, as it is right now """
+        actors = self.sim.suppliers if actor == "Supplier" else self.sim.sellers
+        try:
+            return repr(actors[ind])
+        except IndexError: # Removed since the frame was drawn
+            return "{} {} is no longer trading".format(actor, ind)
+
+    def stop(self):
+        self.stopped.set()
+        self.running.set() # Wake the step loop if it is paused
+
+    def wait(self):
+        """ Blocks while paused. Returns False once the run should stop """
+        self.running.wait()
+        return not self.stopped.is_set()
+
+def run_sim(num_trials, sim, detector=None, recorder=None, monitor=None, metrics=None):
+    import matplotlib.pyplot as plt
+    from multiprocessing import Process, Queue, Pipe
+    from animator import Animator
 
     x       = [seller.position[0] for seller in sim.sellers]
     y       = [seller.position[1] for seller in sim.sellers]
@@ -273,37 +463,30 @@ def run_sim(num_trials, sim):
     towns   = []
     if sim.environment:
         towns = sim.environment.towns
-        plot_queue.put( (x, y, q, supx, supy, supq, towns) )
+        frame = (x, y, q, supx, supy, supq, towns)
     else:
-        plot_queue.put( (x, q, supx, supq) )
+        frame = (x, q, supx, supq)
+    plot_queue.put(frame)
 
     animator = Animator(plot_queue, theirs)
     animator_proc = Process(target=animator.animate)
     animator_proc.start()
+    theirs.close()
+    controller = Controller(sim, mine)
 
-    mean_qualities = []
+    mean_qualities = [] if sim.history is None else MetricHistory(sim.history)
     for i in range(num_trials):
-        if (mine.poll()):
-            request = mine.recv()
-            if request == "Pause":
-                wait_for_input(sim, mine)
-            elif request == "Stop":
-                global stop
-                stop = True
-                return # This stops everything
-            else:
-                actor, ind = request
-                if actor == "Supplier":
-                    mine.send([sim.suppliers[ind]])
-                else:
-                    mine.send([sim.sellers[ind]])
-
-            if stop:
-                return
+        if not controller.wait():
+            return # The animation was closed
 
 
         #sim.time_step_sweep()
         sim.time_step_sto()
+        if metrics is not None:
+            metrics.publish(sim)
+        if monitor is not None and monitor.due(i):
+            # The last frame sent stands in for the size of the ones queued
+            monitor.record(i, sim, plot_queue, frame_size(frame), (mean_qualities,))
 
         if (i % 10 == 0):
             x       = [seller.position[0] for seller in sim.sellers]
@@ -314,10 +497,14 @@ def run_sim(num_trials, sim):
             supq    = [supplier.quality for supplier in sim.suppliers]
 
             if sim.environment:
-                plot_queue.put( (x, y, q, supx, supy, supq) )
+                frame = (x, y, q, supx, supy, supq)
             else:
-                plot_queue.put( (x, q, supx, supq) )
+                frame = (x, q, supx, supq)
+            plot_queue.put(frame)
             #plot_queue.put( (x, q, supx, supq) )
+            if recorder is not None:
+                recorder.record(i, sim)
+
             qual = sim.watcher.get_mean_qual()
             mean_qualities.append(qual)
             print("Mean Quality: {}".format(qual))
@@ -326,100 +513,290 @@ def run_sim(num_trials, sim):
             top, n = sim.watcher.get_top()
             print("Top seller: {}, picked {} times".format(top, n))
             print("Number failed sales: {}".format(sim.watcher.out_of_stock))
+            for kind, stats in sim.watcher.selection_stats().items():
+                print("{} candidates: width {}, out of stock rate {:.3f}, widened {} times".format(
+                        kind, stats['width'], stats['oos_rate'], stats['widened']))
             #print(sim.watcher.sup_no_sales)
             print("-" * 80)
+            if detector is not None and detector.update(qual):
+                sim.stop_step = i
+                print("Mean quality converged at step {}".format(i))
+                sim.watcher.reset()
+                break
         sim.watcher.reset()
 
     debug("Simulation was {} ahead of animation".format(plot_queue.qsize()))
-    while not plot_queue.empty():
-        time.sleep(0.05)
-        if not (animator_proc.is_alive()):
-            break
-
-    plot_queue.put("Stop")
-    if animator_proc.is_alive():
-        wait_for_input(sim, mine)
-        animator_proc.join()
+    plot_queue.put("Stop") # The Animator holds the last frame once it gets here
+    # Actors can still be inspected until the animation is closed
+    animator_proc.join()
+    controller.stop()
 
     plt.clf()
     time.sleep(0.1)
 
-    plt.plot(range(0, num_trials, 10), mean_qualities)
+    if sim.history is None:
+        plt.plot(range(0, 10*len(mean_qualities), 10), mean_qualities)
+    else:
+        plt.plot(mean_qualities.steps(10), mean_qualities.values())
     plt.show()
 
-def run_sims(ni, nj, nk, num_trials, dynam_price, dynam_actors, num_sims, env_file=None):
+def record_run(num_trials, sim, recorder, record_every=10, detector=None, monitor=None,
+                metrics=None):
+    """
+    Runs a simulation without the animation, writing every record_every'th
+    step to a TrajectoryRecorder so that it can be replayed later
+    """
+    for i in range(num_trials):
+        sim.time_step_sto()
+        if metrics is not None:
+            metrics.publish(sim)
+        if monitor is not None and monitor.due(i):
+            monitor.record(i, sim)
+
+        if (i % record_every == 0):
+            recorder.record(i, sim)
+            qual = sim.watcher.get_mean_qual()
+            if detector is not None and detector.update(qual):
+                sim.stop_step = i
+                break
+        sim.watcher.reset()
+
+    recorder.close()
+
+def replay(directory):
+    """ Opens the Animator on a recorded run """
+    from animator import Animator
+    Animator(None, None, replay=TrajectoryReader(directory)).animate()
+
+def seed_rngs(seed):
+    """ Seeds both random number generators used by the simulation """
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+
+def run_replicate(sim, num_trials, sample_every=2, detector=None, metrics=None):
+    """
+    Runs a simulation headless for num_trials timesteps, recording the mean
+    quality every sample_every steps. Returns the Watcher's quality list. If a
+    ConvergenceDetector is given, the run ends as soon as it reports that the
+    mean quality has settled, and the step is kept in sim.stop_step. Each step
+    is published to metrics, a MetricsPublisher, if given
+    """
+    for j in range(num_trials):
+        sim.time_step_sto()
+        if metrics is not None:
+            metrics.publish(sim)
+        if (j % sample_every == 0):
+            qual = sim.watcher.get_mean_qual()
+            if detector is not None and detector.update(qual):
+                sim.stop_step = j
+                sim.watcher.reset()
+                break
+        sim.watcher.reset()
+
+    return sim.watcher.mean_quality_list
+
+def run_sims(ni, nj, nk, num_trials, dynam_price, dynam_actors, num_sims, env_file=None,
+                seed=None, cache=None, normalise=False, convergence=None, batch=0, metrics=None,
+                antithetic=False, params=None, history=None, target_ci=None):
+    """
+    Runs num_sims headless simulations and plots their mean quality. If a seed
+    is given, replicate i is seeded with seed+i and, when a ResultCache is
+    passed, replicates already in the cache are read back instead of re-run.
+    Runs are folded into an EnsembleAggregator as they finish, so only a small
+    reservoir of them is kept in memory.
+
+    convergence is an optional dictionary of ConvergenceDetector settings. Runs
+    that stop early are held at their final (converged) value for the rest of
+    the ensemble average (with history, at every sample still to come, so that
+    they are compacted like full runs).
+
+    If batch is set, replicates are run batch at a time in lockstep by a
+    BatchedSimulation instead (without caching or early stopping)
+
+    If antithetic is set, replicates are run in pairs that share a seed, the
+    second drawing 1-u for each uniform draw of its initial state and treatment
+    outcomes that the first draws u for. The confidence interval of the
+    average is then taken from the pair averages. The runs of a pair are not
+    independent, so whole runs are kept in this mode
+
+    If target_ci is set, the num_sims runs are a pilot: their spread sets how
+    many runs are needed for a 95% confidence half-width of target_ci at every
+    sampled step, and the rest are then run
+
+    params are the Parameters of every replicate. If history is set, each
+    run's mean quality is kept in a MetricHistory of that size, so that the
+    ensemble's per-step arrays stay bounded however long the runs are
+    """
+    if batch:
+        return run_sims_batched(ni, nj, nk, num_trials, dynam_price, dynam_actors, num_sims,
+                                    env_file, seed, batch, normalise)
+
+    spec = None
+    if cache is not None and seed is not None:
+        spec = run_spec(ni, nj, nk, num_trials, dynam_price, dynam_actors,
+                            env_file, params if params is not None else Parameters(),
+                            convergence=convergence)
+        if antithetic: # Kept apart from independent replicates with the same seeds
+            spec['antithetic'] = True
+        if history is not None:
+            spec['history'] = history
+    if target_ci is not None: # The pilot needs a spread to go on
+        num_sims = max(num_sims, 4 if antithetic else 2)
+    if antithetic and num_sims % 2:
+        num_sims += 1 # Whole pairs only
+
+    n_samples = len(range(0, num_trials, 2))
+    if history is not None: # Full runs are compacted to this many values
+        n_samples = MetricHistory(history).stored(n_samples)
+    stop_steps = []
 
     sys.stdout.write("Running {} different simulaions: ".format(num_sims))
     sys.stdout.write("[%s]" % (" " * num_sims))
     sys.stdout.flush()
     sys.stdout.write("\b" * (num_sims+1))
 
-    sims = []
-    for i in range(num_sims):
-        sim = Simulation(ni, nj, nk, env_file, dynam_price, dynam_actors)
+    ensemble = EnsembleAggregator()
+    normalised = EnsembleAggregator(value_range=(-1., 1.))
+    held = [] # Whole runs, kept for antithetic pairs only
+    i = 0
+    while i < num_sims:
+        cached = None
+        if spec is not None:
+            cached = cache.get(spec, seed+i)
+        if cached is not None:
+            run, stats = cached
+            if stats.get('stop_step', -1) >= 0:
+                stop_steps.append(stats['stop_step'])
+            sys.stdout.write("c")
+        else:
+            run_params = params
+            if antithetic: # Both twins share a seed; the second mirrors the outcomes
+                if seed is not None:
+                    pair_seed = seed + i//2
+                elif i % 2 == 0:
+                    pair_seed = random.randrange(2**32)
+                seed_rngs(pair_seed)
+                values = params.as_dict() if params is not None else {}
+                run_params = Parameters(outcomes=OutcomeStream(pair_seed, antithetic=i % 2 == 1),
+                                        **values)
+            elif seed is not None:
+                seed_rngs(seed+i)
+            # Antithetic runs are built from arrays, so their initial state is mirrored too
+            sim = Simulation(ni, nj, nk, env_file, dynam_price, dynam_actors, run_params,
+                                bulk=antithetic, history=history)
+            if metrics is not None:
+                metrics.set_progress(i, num_sims)
+
+            detector = None
+            if convergence is not None:
+                detector = ConvergenceDetector(**convergence)
+
+            run = run_replicate(sim, num_trials, detector=detector, metrics=metrics)
+            if history is not None: # Held in sample space, before it is compacted further
+                run.hold(len(range(0, num_trials, 2)))
+            run = np.asarray(run)
+            if sim.stop_step is not None:
+                stop_steps.append(sim.stop_step)
+            if spec is not None:
+                stop_step = sim.stop_step if sim.stop_step is not None else -1
+                cache.put(spec, seed+i, run, stop_step=stop_step)
+            sys.stdout.write("#")
+        sys.stdout.flush()
 
-        for j in range(num_trials):
-            sim.time_step_sto()
-            if (j % 2 == 0):
-                sim.watcher.get_mean_qual()
-            sim.watcher.reset()
+        ensemble.add(run, n_samples)
+        if normalise:
+            normalised.add(run - run[0], n_samples)
+        if antithetic:
+            held.append(hold(run, n_samples))
+
+        i += 1
+        if i == num_sims and target_ci is not None:
+            if antithetic: # Counted in pairs, whose averages are the independent values
+                pairs = (np.array(held[0::2]) + np.array(held[1::2])) / 2
+                needed = 2*replicates_needed(pairs.std(axis=0, ddof=1), target_ci)
+            else:
+                needed = replicates_needed(ensemble.std(), target_ci)
+            if needed > num_sims:
+                sys.stdout.write("\nRunning {} more for a 95% CI half-width of {}: ".format(
+                                    needed - num_sims, target_ci))
+                sys.stdout.flush()
+                num_sims = needed
+    sys.stdout.write("\n")
 
-        sims.append(sim.watcher.mean_quality_list)
+    if stop_steps:
+        print("{} of {} runs converged early, at a mean step of {:.0f}".format(
+                len(stop_steps), num_sims, np.mean(stop_steps)))
+
+    # 95% confidence interval of the average, from independent values only
+    half_width = Z95*ensemble.stderr()
+    if antithetic:
+        result = antithetic_mean(held)
+        half_width = result['half_width']
+        print("Antithetic pairs: mean 95% CI half-width {:.4f}, against {:.4f} for as many "
+                "independent runs ({:.1f}x median variance reduction)".format(
+                    half_width.mean(), result['independent_half_width'].mean(),
+                    np.median(result['reduction'])))
+    else:
+        print("Mean 95% CI half-width {:.4f}".format(half_width.mean()))
+
+    plot_ensemble(ensemble, num_trials, half_width)
 
-        sys.stdout.write("#")
+    if normalise: # Runs relative to their starting quality
+        import matplotlib.pyplot as plt
+        plt.clf()
+        plot_ensemble(normalised, num_trials)
+
+def run_sims_batched(ni, nj, nk, num_trials, dynam_price, dynam_actors, num_sims, env_file,
+                        seed, batch, normalise=False):
+    """ run_sims, with the replicates advanced batch at a time in one process """
+    from batched import BatchedSimulation
+
+    sys.stdout.write("Running {} different simulaions in batches of {}\n".format(num_sims, batch))
+    ensemble = EnsembleAggregator()
+    normalised = EnsembleAggregator(value_range=(-1., 1.))
+    for first in range(0, num_sims, batch):
+        size = min(batch, num_sims - first)
+        sim = BatchedSimulation(size, ni, nj, nk, env_file, dynam_price, dynam_actors,
+                                    seed=None if seed is None else seed + first)
+        for run in sim.run(num_trials):
+            ensemble.add(run)
+            if normalise:
+                normalised.add(run - run[0])
+        sys.stdout.write("#" * size)
         sys.stdout.flush()
     sys.stdout.write("\n")
 
-    x = np.linspace(0, num_trials, len(sims[0]))
-    plt.plot(x, sims[i], c='b', alpha=0.2, label="Individual Run")
-    for i in range(1, num_sims):
-        plt.plot(x, sims[i], c='b', alpha=0.2)
+    plot_ensemble(ensemble, num_trials)
 
-    avg = []
-    for j in range(len(sims[0])):
-        temp = 0
-        for i in range(num_sims):
-            temp += sims[i][j]
-        avg.append(temp/num_sims)
+    if normalise:
+        import matplotlib.pyplot as plt
+        plt.clf()
+        plot_ensemble(normalised, num_trials)
 
-    plt.plot(x, avg, c='r', label="Average", linewidth=2)
+def plot_ensemble(ensemble, num_trials, half_width=None):
+    """
+    Plots the sampled individual runs and the average of an ensemble, with the
+    confidence interval of the average if its half_width is given
+    """
+    import matplotlib.pyplot as plt
+    x = np.linspace(0, num_trials, len(ensemble))
+    for i, run in enumerate(ensemble.reservoir):
+        label = "Individual Run" if i == 0 else None
+        plt.plot(x[:len(run)], run, c='b', alpha=0.2, label=label)
+
+    plt.fill_between(x, ensemble.quantile(0.05), ensemble.quantile(0.95),
+                        color='r', alpha=0.1, label="5-95% of runs")
+    if half_width is not None:
+        plt.fill_between(x, ensemble.mean - half_width, ensemble.mean + half_width,
+                            color='r', alpha=0.3, label="95% CI of average")
+    plt.plot(x, ensemble.mean, c='r', label="Average", linewidth=2)
     plt.xlabel("Timestep")
     plt.ylabel("Average Purchased Medicine Quality")
     plt.legend()
 
     plt.show()
 
-    if False: # Enable this for normalisation plot
-        plt.clf()
-
-        for i in range(num_sims):
-            beg = sims[i][0]
-            for j in range(len(sims[i])):
-                sims[i][j] = sims[i][j] - beg
-
-        x = np.linspace(0, num_trials, len(sims[0]))
-        plt.plot(x, sims[i], c='b', alpha=0.2, label="Individual Run")
-        for i in range(1, num_sims):
-            plt.plot(x, sims[i], c='b', alpha=0.2)
-
-        avg = []
-        for j in range(len(sims[0])):
-            temp = 0
-            for i in range(num_sims):
-                temp += sims[i][j]
-            avg.append(temp/num_sims)
-
-        plt.plot(x, avg, c='r', label="Average", linewidth=2)
-        plt.xlabel("Timestep")
-        plt.ylabel("Average Purchased Medicine Quality")
-        plt.legend()
-
-        plt.show()
-
 def main():
-    global stop
-    stop  = False
-
     parser = OptionParser("Usage: >> python trust.py [options] <config_file>")
     parser.add_option("-e", action="store_true", default=False,
         help="Use this option to use the environemt functionality")
@@ -437,9 +814,76 @@ def main():
         help="Use this option to specify the number of suppliers (default: 10)")
     parser.add_option("--series", action="store", default=1, type="int",
         help="Use this option to run a series of simulations and plot the results")
+    parser.add_option("-q", "--quiet", action="store_true", default=False,
+        help="Use this option to hide debug logging")
+    parser.add_option("--bulk", action="store_true", default=False,
+        help="Use this option to build the populations from arrays, creating patients lazily")
+    parser.add_option("--cohorts", action="store_true", default=False,
+        help="Use this option to group patients into weighted cohorts (for very large ni)")
+    parser.add_option("--cell-size", action="store", dest="cell_size", default=None, type="float",
+        help="Use this option with --cohorts to group patients by grid cells of this size")
+    parser.add_option("--events", action="store_true", default=False,
+        help="Use this option to run in continuous time, with actors only acting when an event is due")
+    parser.add_option("--parallel", action="store", default=0, type="int",
+        help="Use this option to split one simulation's patients across this many processes "
+             "(one per town when the environment is used)")
+    parser.add_option("--batch", action="store", default=0, type="int",
+        help="Use this option to run series replicates this many at a time in one process")
+    parser.add_option("--antithetic", action="store_true", default=False,
+        help="Use this option to run series replicates in antithetic pairs")
+    parser.add_option("--target-ci", action="store", dest="target_ci", default=None, type="float",
+        help="Use this option to treat the series as a pilot and run as many more as a 95% CI "
+             "half-width of this size needs")
+    parser.add_option("--seed", action="store", default=None, type="int",
+        help="Use this option to seed the simulations (series runs are cached when set)")
+    parser.add_option("--no-cache", action="store_true", dest="no_cache", default=False,
+        help="Use this option to always recompute series runs instead of using the cache")
+    parser.add_option("--cache-dir", action="store", dest="cache_dir", default=DEFAULT_DIR,
+        help="Use this option to specify the result cache directory")
+    parser.add_option("--cache-size", action="store", dest="cache_size", default=256, type="int",
+        help="Use this option to specify the maximum cache size in MB (default: 256)")
+    parser.add_option("--record", action="store", default=None,
+        help="Use this option to record the run's frames to the given directory")
+    parser.add_option("--headless", action="store_true", default=False,
+        help="Use this option with --record to run without the animation")
+    parser.add_option("--replay", action="store", default=None,
+        help="Use this option to replay a recorded run from the given directory")
+    parser.add_option("--mem", action="store", default=0, type="int",
+        help="Use this option to report memory use by category every this many steps")
+    parser.add_option("--mem-trace", action="store_true", dest="mem_trace", default=False,
+        help="Use this option with --mem to show tracemalloc growth between reports")
+    parser.add_option("--metrics", action="store", default=None,
+        help="Use this option to serve live metrics on this localhost port (or Unix socket path)")
+    parser.add_option("--long", action="store_true", default=False,
+        help="Use this option for very long runs: 32 bit experience counters and "
+             "metric histories compacted to --history values")
+    parser.add_option("--history", action="store", default=10000, type="int",
+        help="Use this option with --long to specify the metric history size (default: 10000)")
+    parser.add_option("--discount", action="store", default=1.0, type="float",
+        help="Use this option to discount past experience by this factor per trial (default: 1)")
+    parser.add_option("--adaptive-top-n", action="store_true", dest="adaptive_top_n", default=False,
+        help="Use this option to rank only as many candidate vendors as stock-outs call for")
+    parser.add_option("--min-top-n", action="store", dest="min_top_n", default=1, type="int",
+        help="Use this option with --adaptive-top-n to set the smallest ranking (default: 1)")
+    parser.add_option("--journal", action="store", default=None,
+        help="Use this option with --da to journal vendors created and gone bust to the given directory")
+    parser.add_option("--converge", action="store_true", default=False,
+        help="Use this option to end runs early once the mean quality has converged")
+    parser.add_option("--window", action="store", default=50, type="int",
+        help="Use this option to specify the convergence window in samples (default: 50)")
+    parser.add_option("--patience", action="store", default=10, type="int",
+        help="Use this option to specify how many stationary samples are needed (default: 10)")
+    parser.add_option("--slope-tol", action="store", dest="slope_tol", default=1e-4, type="float",
+        help="Use this option to specify the maximum slope per sample (default: 1e-4)")
+    parser.add_option("--std-tol", action="store", dest="std_tol", default=0.02, type="float",
+        help="Use this option to specify the maximum standard deviation (default: 0.02)")
 
     (options, args) = parser.parse_args()
 
+    basicConfig(level=WARNING if options.quiet else DEBUG,
+                format='(%(threadName)-10s) %(message)s',
+                )
+
     num_trials = options.n_runs
     ni = options.ni
     nj = options.nj
@@ -447,19 +891,107 @@ def main():
     dynam_price = options.dp
     dynam_actors = options.da
 
+    if options.replay:
+        replay(options.replay)
+        return
+
+    convergence = None
+    if options.converge:
+        convergence = {'window': options.window, 'patience': options.patience,
+                        'slope_tol': options.slope_tol, 'std_tol': options.std_tol}
+
+    metrics = None
+    if options.metrics:
+        if options.batch and options.series > 1:
+            parser.error("--metrics cannot be used with --batch")
+        from metrics import MetricsPublisher, serve_metrics # Only load the server if asked
+        metrics = MetricsPublisher()
+        serve_metrics(metrics, options.metrics)
+
+    params = Parameters(experience_dtype='int32' if options.long else 'int16',
+                        discount=options.discount, adaptive_top_n=options.adaptive_top_n,
+                        min_top_n=options.min_top_n)
+    history = options.history if options.long else None
+
+    if options.cohorts and (options.long or options.discount != 1 or options.adaptive_top_n):
+        parser.error("--long, --discount and --adaptive-top-n cannot be used with --cohorts")
+
+    if options.events and (options.series > 1 or options.batch or options.antithetic
+                            or options.target_ci is not None or options.cohorts
+                            or options.cell_size is not None or options.parallel):
+        parser.error("--events runs a single per-patient simulation, so it cannot be used "
+                     "with --series, --batch, --antithetic, --target-ci, --cohorts, "
+                     "--cell-size or --parallel")
+
     if options.series > 1:
+        if options.batch and (options.long or options.discount != 1 or options.adaptive_top_n):
+            parser.error("--long, --discount and --adaptive-top-n cannot be used with --batch")
+        if options.batch and options.target_ci is not None:
+            parser.error("--target-ci cannot be used with --batch")
+        if options.batch and (options.converge or options.antithetic):
+            parser.error("--converge and --antithetic cannot be used with --batch")
+        cache = None
+        if not options.no_cache:
+            cache = ResultCache(options.cache_dir, options.cache_size * 1024**2)
+
         if options.e:
-            run_sims(ni, nj, nk, num_trials, dynam_price, dynam_actors, options.series, args[0])
+            run_sims(ni, nj, nk, num_trials, dynam_price, dynam_actors, options.series, args[0],
+                        options.seed, cache, convergence=convergence, batch=options.batch,
+                        metrics=metrics, antithetic=options.antithetic, params=params,
+                        history=history, target_ci=options.target_ci)
         else:
-            run_sims(ni, nj, nk, num_trials, dynam_price, dynam_actors, options.series)
+            run_sims(ni, nj, nk, num_trials, dynam_price, dynam_actors, options.series, None,
+                        options.seed, cache, convergence=convergence, batch=options.batch,
+                        metrics=metrics, antithetic=options.antithetic, params=params,
+                        history=history, target_ci=options.target_ci)
 
     else:
-        if options.e:
-            sim = Simulation(ni, nj, nk, args[0], dynam_price, dynam_actors)
+        if options.seed is not None:
+            seed_rngs(options.seed)
+        env_file = args[0] if options.e else None
+        if options.parallel:
+            from parallel import PartitionedSimulation
+            sim = PartitionedSimulation(ni, nj, nk, env_file, dynam_price, dynam_actors, params,
+                                        processes=options.parallel, seed=options.seed)
+        elif options.events:
+            from events import EventSimulation
+            sim = EventSimulation(ni, nj, nk, env_file, dynam_price, dynam_actors, params,
+                                    bulk=options.bulk, history=history)
         else:
-            sim = Simulation(ni, nj, nk, None, dynam_price, dynam_actors)
-
-        run_sim(num_trials, sim)
+            sim = Simulation(ni, nj, nk, env_file, dynam_price, dynam_actors, params,
+                                bulk=options.bulk, cohorts=options.cohorts,
+                                cell_size=options.cell_size, history=history)
+
+        detector = None
+        if convergence is not None:
+            detector = ConvergenceDetector(**convergence)
+        monitor = None
+        if options.mem:
+            monitor = MemoryMonitor(options.mem, options.mem_trace)
+
+        recorder = None
+        if options.record:
+            recorder = TrajectoryRecorder(options.record, sim)
+        if options.journal:
+            sim.journal = ChurnJournal(options.journal, sim)
+
+        try:
+            if options.headless:
+                if recorder is None:
+                    parser.error("--headless requires --record")
+                record_run(num_trials, sim, recorder, detector=detector, monitor=monitor,
+                            metrics=metrics)
+            else:
+                run_sim(num_trials, sim, detector, recorder, monitor, metrics)
+                if recorder is not None:
+                    recorder.close()
+        finally:
+            if monitor is not None:
+                monitor.stop()
+            if sim.journal is not None:
+                sim.journal.close()
+            if options.parallel:
+                sim.close()
 
 
 if __name__ == "__main__":
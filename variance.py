@@ -0,0 +1,74 @@
+"""
+This file holds the estimators for variance-reduced ensembles.
+
+Two ways of running replicates make averages converge with fewer runs:
+    common random numbers   Replicate r of every parameter set uses the same
+                            seeds, so differences between sets are measured on
+                            paired runs and most of the run-to-run noise cancels
+    antithetic replicates   Runs come in pairs with the same seed, where the
+                            second draws 1-u for every treatment outcome the
+                            first draws u for. The pair's average varies less
+                            than the average of two independent runs
+Since paired runs are not independent, confidence intervals must be built from
+one value per pair (the difference, or the pair's mean) rather than from the
+runs themselves. Each estimator also returns the interval that independent
+runs would have given, and the ratio of variances between the two.
+"""
+import math
+
+import numpy as np
+
+Z95 = 1.959963984540054 # Two-sided 95% normal quantile
+
+
+def mean_ci(samples, z=Z95):
+    """
+    Mean and confidence interval half-width of independent samples, along the
+    first axis
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    n = len(samples)
+    if n < 2:
+        return samples.mean(axis=0), np.full(samples.shape[1:], np.inf)
+    return samples.mean(axis=0), z*samples.std(axis=0, ddof=1)/math.sqrt(n)
+
+
+def reduction(independent_var, paired_var):
+    """ How many times fewer runs the paired estimate needs for the same precision """
+    return np.where(paired_var > 0, independent_var / np.maximum(paired_var, 1e-300), np.inf)
+
+
+def paired_difference(a, b, z=Z95):
+    """
+    Compares two parameter sets run on common random numbers. a and b are
+    (replicates, samples) arrays whose rows were run with the same seeds.
+    Returns the mean difference b - a with its paired and unpaired confidence
+    half-widths, and the variance reduction from pairing
+    """
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    diff, half_width = mean_ci(b - a, z)
+    unpaired_var = a.var(axis=0, ddof=1) + b.var(axis=0, ddof=1)
+    return {'difference': diff, 'half_width': half_width,
+            'unpaired_half_width': z*np.sqrt(unpaired_var / len(a)),
+            'reduction': reduction(unpaired_var, (b - a).var(axis=0, ddof=1))}
+
+
+def antithetic_mean(runs, z=Z95):
+    """
+    The mean of runs made in antithetic pairs, (2*pairs, samples) with the
+    twins of each pair next to each other. Returns the mean with its confidence
+    half-width from the pair averages, the half-width the same number of
+    independent runs would give, and the variance reduction
+    """
+    runs = np.asarray(runs, dtype=np.float64)
+    pairs = (runs[0:len(runs) - 1:2] + runs[1::2]) / 2
+    mean, half_width = mean_ci(pairs, z)
+    independent_var = runs.var(axis=0, ddof=1) / 2 # Variance of the mean of two runs
+    return {'mean': mean, 'half_width': half_width,
+            'independent_half_width': z*np.sqrt(independent_var / len(pairs)),
+            'reduction': reduction(independent_var, pairs.var(axis=0, ddof=1))}
+
+
+def replicates_needed(std, half_width, z=Z95):
+    """ Independent values of standard deviation std needed for a confidence half-width """
+    return int(math.ceil((z*np.max(std)/half_width)**2))